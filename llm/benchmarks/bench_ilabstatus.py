@@ -0,0 +1,116 @@
+"""
+Benchmark do motor ilabstatus com uma árvore de estado sintética.
+
+Mede, para milhares de devices:
+- a construção do índice (uma vez por snapshot);
+- o custo por query no caminho normal (search() sobre o snapshot do status_poller);
+- o custo por query no fallback sem poller (corpo do feed), com o índice em cache e no caso
+  "tudo operacional";
+- o custo por query quando o índice é reconstruído a cada pedido (equivalente ao percurso
+  completo da árvore que o motor fazia antes).
+
+Uso:
+    python bench_ilabstatus.py --devices 5000 --down-ratio 0.01 --queries 2000
+"""
+import os
+import sys
+import io
+import json
+import time
+import random
+import argparse
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'searxng', 'searxng'))
+import ilabstatus
+
+SLUGS = list(ilabstatus.ALIASES) + ['datacenter', 'telefones', 'biblioteca', 'sigarra', 'laboratorios']
+QUERIES = [
+    'o eduroam não liga no telemóvel', 'vpn forticlient em casa', 'moodle não abre',
+    'impressora papercut sem papel', 'site da faculdade em baixo', 'como mudar a password',
+    'outlook não envia email', 'estado dos serviços', 'dns do dominio fep', 'wifi lenta na biblioteca',
+]
+
+def synthetic_tree(devices, down_ratio, groups_per_service=10, seed=42):
+    rng = random.Random(seed)
+    per_group = max(1, devices // (len(SLUGS) * groups_per_service))
+    tree = []
+    for slug in SLUGS:
+        groups = []
+        for g in range(groups_per_service):
+            groups.append({
+                'name': f'{slug} piso {g}', 'slug': slug, 'status': 'operational',
+                'devices': [{
+                    'hostname': f'{slug}-ap-{g}-{d}', 'hostid': f'{slug}{g}{d}',
+                    'state': 'down' if rng.random() < down_ratio else 'operational'
+                } for d in range(per_group)]
+            })
+        tree.append({'name': slug.title(), 'slug': slug, 'status': 'operational', 'groups': groups})
+    incidents = [{'title': 'Falha elétrica no polo 2', 'slug': 'datacenter', 'status': 'down', 'id': 1}] if down_ratio else []
+    return {'incidents': incidents, 'tree': tree}
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def time_search(queries):
+    """Caminho normal do motor: search() sobre o snapshot do poller."""
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        ilabstatus.search(query, {})
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def time_queries(content, queries, rebuild):
+    """Caminho de fallback do motor (corpo do feed -> índice -> query), com ou sem reconstrução."""
+    timings = []
+    for query in queries:
+        if rebuild: ilabstatus._status_index = (None, None)
+        start = time.perf_counter()
+        index = ilabstatus.index_from_content(content)
+        tokens = ilabstatus.query_tokens(query)
+        index.match(tokens, not tokens.isdisjoint(ilabstatus.FORCE_TRIGGERS))
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def report(label, timings):
+    print(f"{label:32s} p50 {percentile(timings, 0.5) * 1000:8.3f} ms   p99 {percentile(timings, 0.99) * 1000:8.3f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark do índice do motor ilabstatus")
+    parser.add_argument('--devices', type=int, default=5000)
+    parser.add_argument('--down-ratio', type=float, default=0.01, help="Fração de devices em baixo")
+    parser.add_argument('--queries', type=int, default=2000)
+    args = parser.parse_args()
+
+    data = synthetic_tree(args.devices, args.down_ratio)
+    content = json.dumps(data).encode('utf-8')
+    healthy = json.dumps(synthetic_tree(args.devices, 0.0)).encode('utf-8')
+    queries = [QUERIES[i % len(QUERIES)] for i in range(args.queries)]
+    print(f"Árvore sintética: {args.devices} devices, {len(content) / 1024:.0f} KiB de JSON")
+
+    # O motor escreve a query em stderr a cada pedido: silenciado para não medir o terminal
+    with contextlib.redirect_stderr(io.StringIO()), tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        index = ilabstatus.build_status_index(data)
+        build = time.perf_counter() - start
+        print(f"Construção do índice: {build * 1000:.1f} ms ({len(index.alerts)} alertas, {len(index.keywords)} palavras-chave)")
+
+        snapshot_kib = len(json.dumps(index.to_dict())) / 1024
+        print(f"Snapshot do poller: {snapshot_kib:.0f} KiB")
+
+        ilabstatus.SNAPSHOT_FILE = os.path.join(tmp, 'status_snapshot.json')
+        with open(ilabstatus.SNAPSHOT_FILE, 'w', encoding='utf-8') as f:
+            json.dump(index.to_dict(), f)
+        report("search() com snapshot", time_search(queries))
+
+        ilabstatus._status_index = (None, None)
+        report("Fallback com índice", time_queries(content, queries, rebuild=False))
+        report("Fallback a reconstruir o índice", time_queries(content, queries[:max(1, args.queries // 20)], rebuild=True))
+        ilabstatus._status_index = (None, None)
+        report("Fallback tudo operacional", time_queries(healthy, queries, rebuild=False))
+
+if __name__ == '__main__':
+    main()
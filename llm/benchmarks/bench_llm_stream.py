@@ -0,0 +1,115 @@
+"""
+Benchmark do descodificador de streams partilhado (llm/common/llm_stream.py).
+
+Gera streams longos sintéticos nos três formatos que os serviços recebem (SSE OpenAI,
+NDJSON Ollama e SSE IAEDU), partidos em blocos de bytes de tamanho aleatório (com caracteres
+UTF-8 cortados a meio), e compara:
+- o StreamDecoder (bytes -> deltas, texto juntado uma vez no fim);
+- o parser antigo dos serviços (iter_lines() do httpx, json.loads por linha e `full_text +=`).
+
+Uso:
+    python bench_llm_stream.py --tokens 20000 --runs 5
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from llm_stream import StreamDecoder, iter_deltas
+
+WORDS = ['Para ', 'configurar ', 'a ', 'VPN ', 'instale ', 'o ', 'FortiClient ', 'e ', 'autentique-se ',
+         'com ', 'as ', 'credenciais ', 'institucionais. ', 'Ligação ', 'à ', 'rede ', 'eduroam ', '✓ ', '\n\n']
+
+def synthetic_stream(fmt, tokens, seed=42):
+    """Corpo do stream e texto esperado."""
+    rng = random.Random(seed)
+    words = [rng.choice(WORDS) for _ in range(tokens)]
+    lines = []
+    for word in words:
+        if fmt == 'openai':
+            lines.append('data: ' + json.dumps({"id": "chatcmpl-1", "object": "chat.completion.chunk",
+                                                 "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]}) + '\n\n')
+        elif fmt == 'ollama':
+            lines.append(json.dumps({"model": "llama3", "created_at": "2024-01-01T00:00:00Z", "response": word, "done": False}) + '\n')
+        else:
+            lines.append('data: ' + json.dumps({"type": "token", "content": word}) + '\n')
+    if fmt == 'ollama':
+        lines.append(json.dumps({"model": "llama3", "response": "", "done": True}) + '\n')
+    else:
+        lines.append('data: [DONE]\n\n')
+    return ''.join(lines).encode('utf-8'), ''.join(words)
+
+def split_chunks(body, min_size, max_size, seed=7):
+    rng = random.Random(seed)
+    chunks = []
+    pos = 0
+    while pos < len(body):
+        size = rng.randint(min_size, max_size)
+        chunks.append(body[pos:pos + size])
+        pos += size
+    return chunks
+
+def response_for(chunks):
+    # Resposta httpx em streaming, como a que os serviços recebem do client.stream()
+    return httpx.Response(200, headers={"Content-Type": "text/event-stream; charset=utf-8"}, content=iter(chunks))
+
+def legacy_parse(chunks):
+    """Parser anterior: iter_lines() do httpx + json.loads por linha + `full_text +=`."""
+    full_text = ""
+    for line in response_for(chunks).iter_lines():
+        if not line: continue
+        json_str = line.replace('data: ', '', 1) if line.startswith('data: ') else line
+        if json_str.strip() == "[DONE]": break
+        try:
+            chunk = json.loads(json_str)
+            content = ""
+            if 'message' in chunk:
+                content = chunk['message']
+            elif 'choices' in chunk and len(chunk['choices']) > 0:
+                content = chunk['choices'][0].get('delta', {}).get('content', '') or chunk['choices'][0].get('text', '')
+            elif 'response' in chunk:
+                content = chunk['response']
+            elif 'type' in chunk and chunk['type'] == 'token':
+                content = chunk.get('content', '')
+            if content: full_text += content
+        except: continue
+    return full_text
+
+def decoder_parse(chunks):
+    decoder = StreamDecoder()
+    for _ in iter_deltas(response_for(chunks).iter_bytes(), decoder): pass
+    return decoder.text()
+
+def best_of(func, chunks, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = func(chunks)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark do descodificador de streams de LLM")
+    parser.add_argument('--tokens', type=int, default=20000, help="Tokens por stream")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--min-chunk', type=int, default=1, help="Tamanho mínimo dos blocos de bytes")
+    parser.add_argument('--max-chunk', type=int, default=4096, help="Tamanho máximo dos blocos de bytes")
+    args = parser.parse_args()
+
+    for fmt in ('openai', 'ollama', 'iaedu'):
+        body, expected = synthetic_stream(fmt, args.tokens)
+        chunks = split_chunks(body, args.min_chunk, args.max_chunk)
+        legacy, legacy_text = best_of(legacy_parse, chunks, args.runs)
+        shared, shared_text = best_of(decoder_parse, chunks, args.runs)
+        assert legacy_text == expected and shared_text == expected, f"{fmt}: texto diferente do esperado"
+        print(f"{fmt:7s} {len(body) / 1024:7.0f} KiB em {len(chunks):6d} blocos   "
+              f"antigo {legacy * 1000:8.1f} ms   StreamDecoder {shared * 1000:8.1f} ms   "
+              f"({shared / args.tokens * 1e6:.2f} µs/token)")
+
+if __name__ == '__main__':
+    main()
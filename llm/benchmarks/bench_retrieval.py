@@ -0,0 +1,364 @@
+"""
+Benchmark de recuperação (qualidade vs latência) de todas as fontes de contexto do chat_proxy.
+
+Corre um conjunto de perguntas de helpdesk etiquetadas (fixtures/retrieval/questions.json,
+com as fontes esperadas de cada uma) contra substitutos locais das fontes:
+- kb: search_local_knowledge() sobre uma knowledge_base.json de teste;
+- tickets: motor tickets -> search_api.py real (subprocesso) com um Elasticsearch falso em memória;
+- updigital: motor updigital em modo portal, com o portal simulado a partir de páginas HTML guardadas;
+- updigital_index: motor updigital em modo índice (índice FTS5 do updigital_crawler.py sobre as mesmas páginas);
+- ilabstatus: motor ilabstatus sobre um snapshot do status_poller gerado a partir de um feed JSON;
+- aggregate_context: o caminho completo do chat_proxy (plano KB/web, kill switch, orçamento de contexto).
+
+Para cada fonte mede recall@k, ruído (resultados em perguntas sem nada esperado dessa fonte),
+tokens de contexto produzidos (montados pelo ContextAssembler, como no prompt) e latência p50/p99.
+As latências são o custo local (processamento e pedidos HTTP locais): não incluem a rede nem
+o Elasticsearch reais.
+
+Uso:
+    python bench_retrieval.py --runs 5 --k 1,3,5
+    python bench_retrieval.py --updigital portal --json resultados.json
+    python bench_retrieval.py --fixtures ./meu_conjunto        # Outro conjunto (mesma estrutura)
+"""
+import os
+import io
+import re
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import tempfile
+import unicodedata
+import subprocess
+import contextlib
+from collections import Counter
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+LLM_DIR = os.path.join(BENCH_DIR, '..')
+ENGINES_DIR = os.path.join(LLM_DIR, 'searxng', 'searxng')
+SEARCH_API = os.path.join(LLM_DIR, 'otobo-elasticsearch-search-api', 'search_api.py')
+# Corre o search_api.py sem alterações, mas numa porta livre (a 5678 pode estar em uso pela API real)
+SEARCH_API_LAUNCHER = '''
+import sys, runpy, socketserver
+class BenchServer(socketserver.TCPServer):
+    def __init__(self, address, handler):
+        super().__init__((address[0], int(sys.argv[2])), handler)
+socketserver.TCPServer = BenchServer
+runpy.run_path(sys.argv[1], run_name='__main__')
+'''
+PORTAL_HOST = 'www.up.pt'
+PORTAL_SEARCH_PATH = '/portal/pt/updigital/search/'
+PORTAL_RESULTS = 10
+
+sys.path.insert(0, ENGINES_DIR)
+sys.path.insert(0, os.path.join(LLM_DIR, 'searxng'))
+import ilabstatus
+import updigital_crawler
+
+SOURCES = ('kb', 'ilabstatus', 'tickets', 'updigital', 'updigital_index')
+# Etiquetas de questions.json usadas por cada fonte (os dois modos do updigital partilham as do updigital)
+LABELS = {'kb': 'kb', 'ilabstatus': 'ilabstatus', 'tickets': 'tickets', 'updigital': 'updigital', 'updigital_index': 'updigital'}
+# Resultados web que entram no prompt no plano FULL do chat_proxy
+WEB_RESULTS = 3
+
+# ==============================================================================
+# 1. SUBSTITUTOS LOCAIS DAS FONTES
+# ==============================================================================
+
+def load_pages(directory):
+    """Páginas guardadas do UPdigital: {caminho do URL canónico: (url, título, conteúdo, html)}."""
+    pages = {}
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(('.html', '.htm')): continue
+        with open(os.path.join(directory, name), 'r', encoding='utf-8') as f:
+            page_html = f.read()
+        title, content, dom = updigital_crawler.parse_page(page_html)
+        url = dom.xpath("//link[@rel='canonical']/@href")[0]
+        pages[httpx.URL(url).path] = (url, title, content, page_html)
+    return pages
+
+def terms(text):
+    # Palavras sem acentos, como a pesquisa do portal
+    text = unicodedata.normalize('NFD', text.lower())
+    return {t for t in re.findall(r'\w+', ''.join(c for c in text if unicodedata.category(c) != 'Mn')) if len(t) > 2}
+
+class PortalTransport(httpx.BaseTransport):
+    """
+    Portal UPdigital simulado: a pesquisa devolve a lista (mesmo HTML que o motor analisa) das páginas
+    guardadas com mais palavras da query; as páginas de detalhe são as guardadas. Pedidos a outros
+    anfitriões (search_api local) seguem para a rede.
+    """
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.page_terms = {path: terms(f"{title} {content}") for path, (_, title, content, _) in pages.items()}
+        self.network = httpx.HTTPTransport()
+
+    def listing(self, query):
+        wanted = terms(query)
+        ranked = sorted(((len(wanted & page_terms), path) for path, page_terms in self.page_terms.items()), key=lambda item: -item[0])
+        items = ''.join(f'<li><a href="{path}">{self.pages[path][1]}</a></li>' for score, path in ranked[:PORTAL_RESULTS] if score)
+        return f'<html><body><main><h1>Pesquisa</h1><ul>{items}</ul></main></body></html>'
+
+    def handle_request(self, request):
+        if request.url.host != PORTAL_HOST: return self.network.handle_request(request)
+        if request.url.path.startswith(PORTAL_SEARCH_PATH):
+            return httpx.Response(200, html=self.listing(request.url.params.get('query', '')))
+        page = self.pages.get(request.url.path)
+        if page is None: return httpx.Response(404)
+        return httpx.Response(200, html=page[3])
+
+def port_in_use(address):
+    with contextlib.suppress(OSError), socket.create_connection(address, timeout=0.2):
+        return True
+    return False
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+@contextlib.contextmanager
+def search_api_server(tickets_file, workdir):
+    """
+    search_api.py real num subprocesso, com o Elasticsearch falso (fixtures/retrieval/fake_es) à frente
+    no PYTHONPATH. Devolve o URL da API.
+    """
+    port = free_port()
+    fake_es = os.path.join(os.path.dirname(tickets_file), 'fake_es')
+    env = dict(os.environ, BENCH_TICKETS_FILE=tickets_file,
+               PYTHONPATH=os.pathsep.join(filter(None, [fake_es, os.environ.get('PYTHONPATH')])))
+    log_path = os.path.join(workdir, 'search_api.log')
+    with open(log_path, 'w') as log:
+        proc = subprocess.Popen([sys.executable, '-c', SEARCH_API_LAUNCHER, SEARCH_API, str(port)], env=env, cwd=workdir, stdout=log, stderr=log)
+    try:
+        started_at = time.monotonic()
+        while not port_in_use(('localhost', port)):
+            if proc.poll() is not None or time.monotonic() - started_at > 10:
+                with open(log_path, 'r') as log:
+                    raise SystemExit(f"search_api.py não arrancou:\n{log.read()}")
+            time.sleep(0.05)
+        yield f'http://localhost:{port}/'
+    finally:
+        proc.terminate()
+        proc.wait(timeout=5)
+
+def search_api_key():
+    # O motor tickets tem de enviar a mesma chave que o search_api.py espera
+    with open(SEARCH_API, 'r', encoding='utf-8') as f:
+        return re.search(r'^API_KEY = "(.*)"', f.read(), re.M).group(1)
+
+def load_chat_proxy(workdir, snapshot_file, index_file):
+    """Importa o chat_proxy com os motores em processo e todo o estado numa diretoria temporária."""
+    os.environ.update(
+        CACHE_DIR=os.path.join(workdir, 'cache'), RETRIEVAL_MODE='inprocess', ENGINES_DIR=ENGINES_DIR,
+        INPROCESS_ENGINES='ilabstatus,tickets,updigital', SEARXNG_EXTRA='false', TRACE_FILE='',
+        STATUS_SNAPSHOT_FILE=snapshot_file, ILABSTATUS_SNAPSHOT_FILE=snapshot_file,
+        STATUS_SNAPSHOT_MAX_AGE='86400', ILABSTATUS_SNAPSHOT_MAX_AGE='86400',
+        UPDIGITAL_INDEX_FILE=index_file, WARMUP_ENABLED='false',
+        QUESTION_LOG='', ROUTING_LOG=os.path.join(workdir, 'routing.jsonl')
+    )
+    sys.path.insert(0, os.path.join(LLM_DIR, 'chat-proxy'))
+    import chat_proxy
+    return chat_proxy
+
+def set_updigital_mode(engine, index_file):
+    # O modo do motor é decidido no carregamento (UPDIGITAL_INDEX_FILE); aqui muda entre pesquisas
+    engine.INDEX_FILE = index_file or ''
+    engine.engine_type = 'offline' if index_file else 'online'
+
+# ==============================================================================
+# 2. MEDIÇÃO
+# ==============================================================================
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def needles(source, labels, kb_entries):
+    """Texto que identifica cada item esperado nos resultados (ou no contexto final)."""
+    if source == 'kb': return [kb_entries[label][:60] for label in labels]
+    if source == 'tickets': return [f"TicketID={label}" for label in labels]
+    if source == 'ilabstatus': return [f"'{label}" for label in labels]
+    return [f"/updigital/{label}/" for label in labels]
+
+def result_text(result):
+    return f"{result.get('title', '')} ({result.get('url', '')})\n{result.get('content', '')}"
+
+class Bench:
+    def __init__(self, cp, questions, kb_entries, runs, reset_caches):
+        self.cp = cp
+        self.questions = questions
+        self.kb_entries = kb_entries
+        self.runs = runs
+        self.reset_caches = reset_caches
+
+    def timed(self, func, question):
+        # Sem caches de pesquisa: cada amostra mede o caminho completo da fonte
+        self.reset_caches()
+        started_at = time.perf_counter()
+        result = func(question)
+        return time.perf_counter() - started_at, result
+
+    def retrieve(self, source, question):
+        """Resultados ordenados da fonte, como texto, e tokens que a fonte sozinha põe no contexto."""
+        cp = self.cp
+        if source == 'kb':
+            elapsed, (hits, _) = self.timed(cp.search_local_knowledge, question)
+            ranked = sorted(hits, key=lambda hit: -hit[0])
+            return elapsed, [content for _, content in ranked], cp.context_assembler.assemble("", ranked, [])
+        engine = 'updigital' if source == 'updigital_index' else source
+        elapsed, results = self.timed(lambda q: cp.local_engines.search(q, engine) or [], question)
+        if source == 'ilabstatus':
+            # Só o primeiro alerta entra no prompt (kill switch)
+            context = cp.outage_alert(results[0]['title'], results[0]['content']) if results else ""
+            return elapsed, [result_text(r) for r in results], cp.context_assembler.assemble(context, [], [])
+        web = [{"title": r.get('title', ''), "url": r.get('url', ''), "snippet": (r.get('content', '') or '').replace('\n', ' ').strip()}
+               for r in results[:WEB_RESULTS]]
+        return elapsed, [result_text(r) for r in results], cp.context_assembler.assemble("", [], web)
+
+    def measure_source(self, source, ks):
+        timings, tokens = [], []
+        recalls = {k: [] for k in ks}
+        noise = []
+        for run in range(self.runs + 1):
+            for item in self.questions:
+                elapsed, texts, context = self.retrieve(source, item['question'])
+                # A primeira passagem aquece ligações e índices e não conta
+                if run == 0: continue
+                timings.append(elapsed)
+                tokens.append(self.cp.estimate_tokens(context) if context else 0)
+                if run > 1: continue
+                labels = item['expected'].get(LABELS[source], [])
+                if not labels:
+                    noise.append(bool(texts))
+                    continue
+                for k in ks:
+                    found = sum(any(needle in text for text in texts[:k]) for needle in needles(source, labels, self.kb_entries))
+                    recalls[k].append(found / len(labels))
+        return {
+            "questions": len(recalls[ks[0]]),
+            "recall": {k: sum(values) / len(values) if values else None for k, values in recalls.items()},
+            "noise": sum(noise) / len(noise) if noise else None,
+            "tokens_avg": sum(tokens) / len(tokens), "tokens_max": max(tokens),
+            "p50_ms": percentile(timings, 0.5) * 1000, "p99_ms": percentile(timings, 0.99) * 1000,
+        }
+
+    def measure_aggregate(self):
+        """aggregate_context(): plano escolhido, tokens do contexto final e que itens esperados lá chegam."""
+        cp = self.cp
+        timings, tokens = [], []
+        coverage = {label: [] for label in ('kb', 'tickets', 'updigital', 'ilabstatus')}
+        plans = Counter()
+        for run in range(self.runs + 1):
+            for item in self.questions:
+                elapsed, context = self.timed(cp.aggregate_context, item['question'])
+                if run == 0: continue
+                timings.append(elapsed)
+                tokens.append(cp.estimate_tokens(context))
+                if run > 1: continue
+                plans[cp.retrieval_planner.plan(cp.search_local_knowledge(item['question'])[1]).name] += 1
+                for source, labels in item['expected'].items():
+                    coverage[source].extend(needle in context for needle in needles(source, labels, self.kb_entries))
+        return {
+            "plans": dict(plans),
+            "coverage": {source: sum(found) / len(found) for source, found in coverage.items() if found},
+            "coverage_total": sum(sum(found) for found in coverage.values()) / sum(len(found) for found in coverage.values()),
+            "tokens_avg": sum(tokens) / len(tokens), "tokens_max": max(tokens),
+            "p50_ms": percentile(timings, 0.5) * 1000, "p99_ms": percentile(timings, 0.99) * 1000,
+        }
+
+# ==============================================================================
+# 3. RELATÓRIO
+# ==============================================================================
+
+def fmt(value, spec='.2f'):
+    return '-' if value is None else format(value, spec)
+
+def report(per_source, aggregate, ks, updigital_mode, budget):
+    header = f"{'Fonte':16s} {'perguntas':>9s} " + " ".join(f"{f'recall@{k}':>9s}" for k in ks) + \
+             f" {'ruído':>6s} {'tokens méd/máx':>15s} {'p50 ms':>8s} {'p99 ms':>8s}"
+    print(header)
+    print('-' * len(header))
+    for source, stats in per_source.items():
+        print(f"{source:16s} {stats['questions']:9d} " + " ".join(f"{fmt(stats['recall'][k]):>9s}" for k in ks) +
+              f" {fmt(stats['noise']):>6s} {stats['tokens_avg']:8.0f} / {stats['tokens_max']:<4d} {stats['p50_ms']:8.2f} {stats['p99_ms']:8.2f}")
+    print(f"\naggregate_context (updigital em modo {updigital_mode}, orçamento {budget} tokens)")
+    print(f"  latência p50 {aggregate['p50_ms']:.2f} ms  p99 {aggregate['p99_ms']:.2f} ms   "
+          f"tokens méd {aggregate['tokens_avg']:.0f} / máx {aggregate['tokens_max']}")
+    print("  planos: " + ", ".join(f"{name} {count}" for name, count in sorted(aggregate['plans'].items())))
+    print("  itens esperados no contexto final: " + ", ".join(f"{source} {value:.2f}" for source, value in aggregate['coverage'].items()) +
+          f"  (total {aggregate['coverage_total']:.2f})")
+
+# ==============================================================================
+# 4. EXECUÇÃO
+# ==============================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de recuperação (recall@k, tokens e latência) das fontes de contexto")
+    parser.add_argument('--fixtures', default=os.path.join(BENCH_DIR, 'fixtures', 'retrieval'), help="Diretoria do conjunto de teste")
+    parser.add_argument('--runs', type=int, default=5, help="Passagens medidas por pergunta (após uma de aquecimento)")
+    parser.add_argument('--k', default='1,3,5', help="Valores de k para o recall@k")
+    parser.add_argument('--updigital', choices=('index', 'portal'), default='index', help="Modo do updigital no aggregate_context")
+    parser.add_argument('--sources', default=','.join(SOURCES), help="Fontes a medir individualmente")
+    parser.add_argument('--json', metavar='FICHEIRO', help="Grava os resultados em JSON")
+    args = parser.parse_args()
+    ks = sorted(int(k) for k in args.k.split(','))
+    sources = [s.strip() for s in args.sources.split(',') if s.strip() in SOURCES]
+
+    fixtures = os.path.abspath(args.fixtures)
+    with open(os.path.join(fixtures, 'questions.json'), 'r', encoding='utf-8') as f:
+        questions = json.load(f)
+    with open(os.path.join(fixtures, 'knowledge_base.json'), 'r', encoding='utf-8') as f:
+        kb_entries = {entry['faq_id']: entry['content'] for entry in json.load(f) if 'faq_id' in entry}
+    with open(os.path.join(fixtures, 'status_feed.json'), 'r', encoding='utf-8') as f:
+        status_feed = json.load(f)
+    labelled = Counter(label for item in questions for label in item['expected'])
+    print(f"{len(questions)} perguntas; etiquetadas por fonte: " + ", ".join(f"{k} {v}" for k, v in sorted(labelled.items())))
+
+    with tempfile.TemporaryDirectory() as workdir:
+        snapshot_file = os.path.join(workdir, 'status_snapshot.json')
+        with open(snapshot_file, 'w', encoding='utf-8') as f:
+            json.dump(ilabstatus.build_status_index(status_feed).to_dict(), f)
+        pages = load_pages(os.path.join(fixtures, 'updigital'))
+        index_file = os.path.join(workdir, 'updigital.db')
+        updigital_crawler.build_index([(url, title, content) for url, title, content, _ in pages.values()], index_file)
+
+        cp = load_chat_proxy(workdir, snapshot_file, index_file)
+        cp.KB_FILE = os.path.join(fixtures, 'knowledge_base.json')
+        transport = PortalTransport(pages)
+        cp.local_engines.pool.client = httpx.Client(transport=transport, timeout=cp.ENGINE_DEFAULT_DEADLINE)
+        updigital = cp.local_engines.engines['updigital']
+        updigital._detail_client = httpx.Client(transport=transport, timeout=updigital.DETAIL_TIMEOUT, follow_redirects=True)
+        tickets = cp.local_engines.engines['tickets']
+        tickets.API_KEY = search_api_key()
+
+        def reset_caches():
+            cp.response_cache.clear()
+            updigital._page_cache.clear()
+
+        bench = Bench(cp, questions, kb_entries, args.runs, reset_caches)
+        per_source = {}
+        # Os serviços e motores escrevem logs e debug em stderr a cada pedido: silenciados durante a medição
+        with search_api_server(os.path.join(fixtures, 'tickets.json'), workdir) as search_api_url, contextlib.redirect_stderr(io.StringIO()):
+            tickets.TICKETS_API_URL = search_api_url
+            logging.disable(logging.CRITICAL)
+            for source in sources:
+                set_updigital_mode(updigital, index_file if source == 'updigital_index' else None)
+                per_source[source] = bench.measure_source(source, ks)
+            set_updigital_mode(updigital, index_file if args.updigital == 'index' else None)
+            aggregate = bench.measure_aggregate()
+            logging.disable(logging.NOTSET)
+
+    report(per_source, aggregate, ks, args.updigital, cp.CONTEXT_TOKEN_BUDGET)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({"questions": len(questions), "runs": args.runs, "updigital_mode": args.updigital,
+                       "sources": per_source, "aggregate_context": aggregate}, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()
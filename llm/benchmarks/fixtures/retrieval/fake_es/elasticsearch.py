@@ -0,0 +1,83 @@
+"""
+Substituto local do cliente Elasticsearch para o bench_retrieval.py.
+
+Posto à frente no PYTHONPATH do search_api.py: o `from elasticsearch import Elasticsearch`
+passa a carregar esta classe, que responde à query DSL do search_api (multi_match em
+best_fields + filtros terms/range/bool) sobre os tickets de BENCH_TICKETS_FILE, em memória.
+A pontuação é um IDF simples por campo (não o BM25 do Elasticsearch): serve para medir o
+percurso search_api -> motor tickets, não a qualidade do ranking do Elasticsearch.
+"""
+import os
+import re
+import json
+import math
+import time
+import unicodedata
+
+def tokens(text):
+    text = unicodedata.normalize("NFD", str(text or "").lower())
+    text = "".join(c for c in text if unicodedata.category(c) != "Mn")
+    return {t for t in re.findall(r"\w+", text) if len(t) > 1}
+
+def field_values(doc, path):
+    """Valores de um campo com caminho (ex: ArticlesExternal.From.keyword), atravessando listas."""
+    values = [doc]
+    for part in path.replace(".keyword", "").split("."):
+        found = []
+        for value in values:
+            items = value if isinstance(value, list) else [value]
+            found.extend(item[part] for item in items if isinstance(item, dict) and part in item)
+        values = found
+    flat = []
+    for value in values:
+        flat.extend(value if isinstance(value, list) else [value])
+    return flat
+
+def matches(doc, clause):
+    if "terms" in clause:
+        (path, accepted), = clause["terms"].items()
+        return any(value in accepted for value in field_values(doc, path))
+    if "range" in clause:
+        (path, bounds), = clause["range"].items()
+        checks = {"gte": lambda v, b: v >= b, "gt": lambda v, b: v > b, "lte": lambda v, b: v <= b, "lt": lambda v, b: v < b}
+        return any(all(checks[op](value, bound) for op, bound in bounds.items() if op in checks) for value in field_values(doc, path))
+    if "bool" in clause:
+        spec = clause["bool"]
+        if not all(matches(doc, c) for c in spec.get("filter", []) + spec.get("must", [])): return False
+        should = spec.get("should", [])
+        return sum(matches(doc, c) for c in should) >= spec.get("minimum_should_match", 1 if should else 0)
+    return True
+
+class Elasticsearch:
+    def __init__(self, hosts=None, **kwargs):
+        with open(os.environ["BENCH_TICKETS_FILE"], "r", encoding="utf-8") as f:
+            docs = json.load(f)
+        now = time.time()
+        self.docs = []
+        for doc in docs:
+            doc = dict(doc)
+            # Datas relativas no fixture: o filtro de 1 ano do search_api continua a valer
+            doc["Created"] = int(now - doc.pop("AgeDays", 0) * 86400)
+            self.docs.append(doc)
+        # Termos de cada documento (para o IDF), calculados uma vez
+        self.doc_terms = [tokens(json.dumps(doc, ensure_ascii=False)) for doc in self.docs]
+        self.searches = 0
+
+    def ping(self):
+        return True
+
+    def _score(self, doc, query, fields, idf):
+        return max((sum(idf[t] for t in query & tokens(" ".join(map(str, field_values(doc, f))))) for f in fields), default=0.0)
+
+    def search(self, index=None, body=None, **kwargs):
+        self.searches += 1
+        spec = body["query"]["bool"]
+        multi_match = spec["must"][0]["multi_match"]
+        query, fields = tokens(multi_match["query"]), multi_match["fields"]
+        candidates = [doc for doc in self.docs if all(matches(doc, c) for c in spec.get("filter", []))]
+        df = {t: sum(1 for terms in self.doc_terms if t in terms) for t in query}
+        idf = {t: math.log(1 + (len(self.docs) - df[t] + 0.5) / (df[t] + 0.5)) for t in query}
+
+        scored = [(self._score(doc, query, fields, idf), doc) for doc in candidates]
+        hits = sorted((item for item in scored if item[0] > 0), key=lambda item: -item[0])[:body.get("size", 10)]
+        return {"hits": {"total": {"value": len(hits)}, "hits": [{"_score": score, "_source": doc} for score, doc in hits]}}
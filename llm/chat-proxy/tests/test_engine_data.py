@@ -0,0 +1,66 @@
+"""
+O ID do pedido chega aos motores pelo engine_data do SearXNG, que é indexado pelo nome do motor
+no settings.yml (não pelo nome do ficheiro). Reproduz a leitura do SearXNG e confirma que cada
+motor recebe o ID.
+
+    cd llm/chat-proxy && python -m pytest -q tests
+"""
+import os
+import sys
+import importlib.util
+from collections import defaultdict
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ENGINES_DIR = os.path.join(HERE, "..", "..", "searxng", "searxng")
+REQUEST_ID = "req-0123456789abcdef"
+
+
+@pytest.fixture(scope="module")
+def cp(tmp_path_factory):
+    os.environ.update(
+        CACHE_DIR=str(tmp_path_factory.mktemp("cache")), ENGINES_DIR=ENGINES_DIR,
+        WARMUP_ENABLED="false", STATUS_SNAPSHOT_FILE="", TRACE_FILE=""
+    )
+    sys.path.insert(0, os.path.join(HERE, ".."))
+    import chat_proxy
+    return chat_proxy
+
+
+def load_engine(module):
+    spec = importlib.util.spec_from_file_location(f"test_engine_{module}", os.path.join(ENGINES_DIR, f"{module}.py"))
+    engine = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(engine)
+    return engine
+
+
+def searxng_engine_data(params, engine_name):
+    # Como searx.webadapter.parse_engine_data + searx.search (engine_data.get(engineref.name, {}))
+    engine_data = defaultdict(dict)
+    for key, value in params.items():
+        if key.startswith("engine_data"):
+            _, engine, name = key.split("-")
+            engine_data[engine][name] = value
+    return engine_data.get(engine_name, {})
+
+
+def test_names_come_from_settings(cp, tmp_path):
+    settings = tmp_path / "settings.yml"
+    settings.write_text(
+        "engines:\n"
+        "  - name: otobo_tickets\n    engine: tickets\n"
+        "  - name: up digital\n    engine: updigital\n"
+        "  - name: wikipedia\n    engine: wikipedia\n",
+        encoding="utf-8"
+    )
+    names = cp.searxng_engine_names(str(settings), ["tickets", "updigital", "ilabstatus"])
+    assert names == {"tickets": ["otobo_tickets"], "updigital": ["up digital"], "ilabstatus": ["ilabstatus"]}
+
+
+@pytest.mark.parametrize("module", ["tickets", "updigital"])
+def test_engines_receive_request_id(cp, module):
+    params = cp.searxng_trace_params(REQUEST_ID)
+    engine = load_engine(module)
+    for name in cp.SEARXNG_ENGINE_NAMES[module]:
+        assert engine.trace_request_id({"engine_data": searxng_engine_data(params, name)}) == REQUEST_ID
@@ -0,0 +1,190 @@
+"""
+Aquecimento da cache de respostas fora de horas.
+
+Pré-gera respostas para as perguntas mais frequentes do QUESTION_LOG e para perguntas
+canónicas derivadas dos triggers da knowledge_base.json, usando o mesmo caminho de geração
+do chat_proxy (contexto RAG, escalonador partilhado, modelo local e regras de cache).
+
+Uso:
+    python warm_cache.py              # Corre se estiver dentro de WARM_CACHE_HOURS
+    python warm_cache.py --force      # Ignora o horário
+    python warm_cache.py --dry-run    # Apenas lista as perguntas candidatas
+"""
+import os
+import sys
+import json
+import logging
+import time
+import argparse
+from collections import Counter
+from threading import Thread, Event, Lock
+
+# O aquecimento já carrega o modelo: não é preciso o ping periódico neste processo
+os.environ.setdefault("WARMUP_ENABLED", "false")
+
+import chat_proxy as cp
+
+# ==============================================================================
+# 1. CONFIGURAÇÃO
+# ==============================================================================
+logger = logging.getLogger('WarmCache')
+
+# Janela de horas vazias [início, fim[ em que o job pode correr
+WARM_CACHE_HOURS = os.getenv("WARM_CACHE_HOURS", "0-7")
+# Janela do registo de perguntas considerada e número mínimo de ocorrências
+WARM_CACHE_LOOKBACK_DAYS = int(os.getenv("WARM_CACHE_LOOKBACK_DAYS", 14))
+WARM_CACHE_MIN_COUNT = int(os.getenv("WARM_CACHE_MIN_COUNT", 3))
+# Máximo de perguntas do registo e de perguntas canónicas por entrada da KB
+WARM_CACHE_TOP = int(os.getenv("WARM_CACHE_TOP", 50))
+WARM_CACHE_KB_TRIGGERS_PER_ENTRY = int(os.getenv("WARM_CACHE_KB_TRIGGERS_PER_ENTRY", 2))
+# Gerações em paralelo (nunca mais do que os slots locais)
+WARM_CACHE_CONCURRENCY = min(int(os.getenv("WARM_CACHE_CONCURRENCY", 1)), cp.LOCAL_SLOTS)
+# Pára se a carga subir acima deste valor ou se houver utilizadores à espera de slot
+WARM_CACHE_MAX_LOAD = float(os.getenv("WARM_CACHE_MAX_LOAD", cp.LOAD_THRESHOLD / 2))
+
+# ==============================================================================
+# 2. PERGUNTAS CANDIDATAS
+# ==============================================================================
+
+def top_logged_questions(path, lookback_days, min_count, top):
+    """Perguntas mais frequentes do registo (e do ficheiro rodado .1): lista de (chave normalizada, texto, ocorrências)."""
+    if not path: return []
+    since = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(time.time() - lookback_days * 86400))
+    counts = Counter()
+    texts = {}
+    # O rodado primeiro: para a mesma chave fica o texto mais recente
+    for file_path in (path + ".1", path):
+        if not os.path.exists(file_path): continue
+        with open(file_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("ts", "") < since or not record.get("key"): continue
+                counts[record["key"]] += 1
+                texts[record["key"]] = record.get("question") or record["key"]
+    return [(key, texts[key], count) for key, count in counts.most_common(top) if count >= min_count]
+
+def kb_canonical_questions(kb_file, per_entry):
+    """Perguntas canónicas da KB: os triggers mais específicos (mais palavras) de cada entrada."""
+    if not os.path.exists(kb_file): return []
+    try:
+        with open(kb_file, "r", encoding="utf-8") as f:
+            kb_data = json.load(f)
+    except Exception as e:
+        logger.error(f"Erro JSON KB: {e}")
+        return []
+
+    questions = []
+    for entry in kb_data:
+        triggers = sorted({t.strip() for t in entry.get("triggers", []) if t.strip()}, key=lambda t: -len(t.split()))
+        for trigger in triggers[:per_entry]:
+            questions.append((cp.normalize_text(trigger), trigger, 0))
+    return questions
+
+def build_candidates():
+    seen = set()
+    candidates = []
+    logged = top_logged_questions(cp.QUESTION_LOG, WARM_CACHE_LOOKBACK_DAYS, WARM_CACHE_MIN_COUNT, WARM_CACHE_TOP)
+    canonical = kb_canonical_questions(cp.KB_FILE, WARM_CACHE_KB_TRIGGERS_PER_ENTRY)
+    # As perguntas reais mais frequentes primeiro; depois as canónicas da KB
+    for key, question, count in logged + canonical:
+        if not key or key in seen: continue
+        seen.add(key)
+        if cp.is_privacy_sensitive(question): continue
+        candidates.append((key, question, count))
+    return candidates
+
+# ==============================================================================
+# 3. GERAÇÃO
+# ==============================================================================
+
+def in_hours(spec, now=None):
+    start, end = cp.parse_range(spec)
+    return start <= time.localtime(now).tm_hour < end
+
+def stop_reason(force):
+    if not force and not in_hours(WARM_CACHE_HOURS): return "fora do horário"
+    try:
+        load1 = os.getloadavg()[0]
+    except OSError:
+        load1 = 0.0
+    if load1 > WARM_CACHE_MAX_LOAD: return f"carga {load1:.2f} > {WARM_CACHE_MAX_LOAD}"
+    if cp.local_scheduler.snapshot()["waiting"] > 0: return "há pedidos de utilizadores em espera"
+    return None
+
+def warm_one(key, question):
+    """Gera e guarda a resposta pelo caminho local do chat_proxy. Devolve 'stored', 'skipped' ou 'failed'."""
+    if cp.is_answer_cached(key): return "skipped"
+    combined_context = cp.aggregate_context(question)
+    with cp.local_scheduler.slot():
+        gen_start = time.monotonic()
+        answer = "".join(cp.stream_local_generation(question, combined_context))
+    ok = bool(answer) and len(answer) >= 5
+    cp.routing_engine.observe("LOCAL", time.monotonic() - gen_start, ok, cp.estimate_tokens(answer))
+    if not ok: return "failed"
+    # store_answer_in_cache aplica as regras NO_CACHE_KEYWORDS
+    return "stored" if cp.store_answer_in_cache(key, answer, source="AQUECIMENTO") else "failed"
+
+def run(candidates, concurrency, force=False):
+    pending = list(reversed(candidates))
+    results = Counter()
+    lock = Lock()
+    stop = Event()
+
+    def worker():
+        while not stop.is_set():
+            reason = stop_reason(force)
+            if reason:
+                if not stop.is_set(): logger.warning(f"Aquecimento interrompido: {reason}.")
+                stop.set()
+                return
+            with lock:
+                if not pending: return
+                key, question, _ = pending.pop()
+            try:
+                outcome = warm_one(key, question)
+            except (cp.LocalQueueFull, cp.LocalQueueTimeout) as e:
+                logger.warning(f"Slot local indisponível ({e}). A parar.")
+                stop.set()
+                return
+            except Exception as e:
+                logger.error(f"Erro a aquecer '{key[:40]}': {e}")
+                outcome = "failed"
+            with lock:
+                results[outcome] += 1
+            logger.info(f"[{outcome}] {key[:60]}")
+
+    threads = [Thread(target=worker, name=f"warm-cache-{i}") for i in range(concurrency)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    results["not_attempted"] = len(pending)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Aquecimento da cache de respostas do chat_proxy")
+    parser.add_argument("--force", action="store_true", help="Ignora WARM_CACHE_HOURS")
+    parser.add_argument("--dry-run", action="store_true", help="Lista as perguntas candidatas sem gerar")
+    args = parser.parse_args()
+
+    candidates = build_candidates()
+    logger.info(f"{len(candidates)} perguntas candidatas.")
+    if args.dry_run:
+        for key, question, count in candidates:
+            cached = "em cache" if cp.is_answer_cached(key) else "por gerar"
+            print(f"{count:5d}  {cached:9s}  {question}")
+        return 0
+
+    reason = stop_reason(args.force)
+    if reason:
+        logger.info(f"Aquecimento não iniciado: {reason}.")
+        return 0
+
+    started_at = time.monotonic()
+    results = run(candidates, WARM_CACHE_CONCURRENCY, args.force)
+    logger.info(f"Aquecimento concluído em {time.monotonic() - started_at:.0f}s: {dict(results)}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,148 @@
+"""
+Descodificador incremental de streams de LLM (SSE e NDJSON), partilhado pelo chat_proxy e
+pelo llm_email_service.
+
+Trabalha sobre bytes, tal como chegam do httpx (iter_bytes/aiter_bytes): acumula apenas a
+linha incompleta num bytearray, descodifica cada linha completa uma única vez e devolve os
+fragmentos de texto (deltas) com metadados de tempo. O texto final é juntado uma vez no fim
+(sem `full_text +=`).
+
+Formatos suportados por linha:
+- SSE `data: {...}` (e `data: [DONE]`); comentários (`:`) e campos `event:`/`id:`/`retry:` são ignorados;
+- NDJSON `{...}` (Ollama);
+- OpenAI `choices[0].delta.content` / `choices[0].text` / `choices[0].message.content`;
+- Ollama `response` (generate) e `message.content` (chat), com `done: true`;
+- IAEDU `message` (texto) e `{"type": "token", "content": ...}`.
+"""
+import json
+import time
+from typing import NamedTuple
+
+# Descodificador reutilizado: evita o detect_encoding() de json.loads() e as regex de espaços de
+# decode() em cada linha (a linha já chega sem espaços nas pontas)
+_json_decode = json.JSONDecoder().raw_decode
+
+
+class Delta(NamedTuple):
+    """Fragmento de texto do stream."""
+    text: str
+    # Posição do fragmento (0 = primeiro token)
+    index: int
+    # Segundos desde o início do pedido e desde o fragmento anterior
+    elapsed: float
+    gap: float
+
+
+def extract_content(chunk):
+    """Texto de um objeto JSON do stream, em qualquer dos formatos suportados ('' se não tiver texto)."""
+    if not isinstance(chunk, dict): return ""
+    message = chunk.get("message")
+    if isinstance(message, str): return message
+    if isinstance(message, dict): return message.get("content") or ""
+    choices = chunk.get("choices")
+    if choices:
+        choice = choices[0]
+        delta = choice.get("delta") or {}
+        return delta.get("content") or choice.get("text") or (choice.get("message") or {}).get("content") or ""
+    if "response" in chunk: return chunk["response"] or ""
+    if chunk.get("type") == "token": return chunk.get("content") or ""
+    return ""
+
+
+class StreamDecoder:
+    """
+    Estado de um stream. feed(bytes) devolve os deltas das linhas completas; close() processa
+    a última linha sem terminador. `done` fica True com `[DONE]` ou `"done": true` (Ollama).
+    """
+
+    def __init__(self, started_at=None, clock=time.monotonic):
+        self._clock = clock
+        self._buffer = bytearray()
+        self.started_at = clock() if started_at is None else started_at
+        self._last_at = self.started_at
+        self.parts = []
+        self.done = False
+        # Linhas com JSON inválido (antes eram engolidas por `except: continue`)
+        self.errors = 0
+        self.first_token_at = None
+
+    def feed(self, data):
+        if self.done or not data: return []
+        self._buffer += data
+        end = self._buffer.rfind(b"\n")
+        if end < 0: return []
+        # Todas as linhas completas do bloco são descodificadas de uma vez (o '\n' nunca corta
+        # um carácter UTF-8); só a linha incompleta fica no buffer
+        lines = self._buffer[:end].decode("utf-8", "replace").split("\n")
+        del self._buffer[:end + 1]
+        # As linhas do mesmo bloco chegaram juntas: um único instante para todas
+        now = self._clock()
+        deltas = []
+        for line in lines:
+            delta = self._decode_line(line, now)
+            if delta is not None: deltas.append(delta)
+            if self.done: break
+        return deltas
+
+    def close(self):
+        """Processa o que restar no buffer (stream terminado sem '\\n')."""
+        if self.done or not self._buffer: return []
+        delta = self._decode_line(self._buffer.decode("utf-8", "replace"), self._clock())
+        self._buffer.clear()
+        return [delta] if delta is not None else []
+
+    def text(self):
+        return "".join(self.parts)
+
+    def _decode_line(self, line, now):
+        line = line.strip()
+        if not line or line[0] == ":": return None
+        if line.startswith("data:"):
+            line = line[5:].lstrip()
+        elif line.startswith(("event:", "id:", "retry:")):
+            return None
+        if line == "[DONE]":
+            self.done = True
+            return None
+
+        try:
+            chunk, _ = _json_decode(line)
+        except ValueError:
+            self.errors += 1
+            return None
+        if isinstance(chunk, dict) and chunk.get("done") is True: self.done = True
+
+        content = extract_content(chunk)
+        if not content: return None
+        if self.first_token_at is None: self.first_token_at = now
+        delta = Delta(content, len(self.parts), now - self.started_at, now - self._last_at)
+        self._last_at = now
+        self.parts.append(content)
+        return delta
+
+    @property
+    def ttft(self):
+        """Tempo até ao primeiro token (None se ainda não chegou nenhum)."""
+        return None if self.first_token_at is None else self.first_token_at - self.started_at
+
+
+def iter_deltas(chunks, decoder=None, on_chunk=None):
+    """Deltas de um iterável de bytes (ex: response.iter_bytes()). on_chunk() é chamado a cada bloco recebido."""
+    decoder = decoder or StreamDecoder()
+    for data in chunks:
+        if on_chunk: on_chunk()
+        yield from decoder.feed(data)
+        if decoder.done: return
+    yield from decoder.close()
+
+
+async def aiter_deltas(chunks, decoder=None, on_chunk=None):
+    """Versão assíncrona de iter_deltas (ex: response.aiter_bytes())."""
+    decoder = decoder or StreamDecoder()
+    async for data in chunks:
+        if on_chunk: on_chunk()
+        for delta in decoder.feed(data):
+            yield delta
+        if decoder.done: return
+    for delta in decoder.close():
+        yield delta
@@ -0,0 +1,176 @@
+"""
+Rastreio leve de pedidos entre serviços (chat_proxy -> SearXNG/motores -> search_api.py).
+
+Cada pedido do /api/chat tem um ID (cabeçalho X-Request-ID) que os motores e a search_api
+propagam. Cada serviço escreve os seus spans (nome, início, duração, estado) como linhas JSON
+num ficheiro local; o trace_view.py junta os ficheiros de vários serviços e desenha a cascata
+de um pedido. Não precisa de rede nem de coletor externo.
+
+Formato de cada linha:
+    {"trace": ID, "span": ID, "parent": ID|null, "service": str, "name": str,
+     "start": epoch (s), "duration": s, "status": "ok"|"error", "attrs": {...}}
+"""
+import os
+import re
+import json
+import time
+import uuid
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+TRACE_HEADER = "X-Request-ID"
+# Ficheiro de spans acima deste tamanho passa a <ficheiro>.1 (uma única cópia)
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", 50 * 1024 * 1024))
+
+logger = logging.getLogger("llm_trace")
+
+# IDs aceites de fora (Apache mod_unique_id, UUIDs): nada que possa partir o JSON ou os logs
+_ID_PATTERN = re.compile(r"[A-Za-z0-9@._-]{8,64}")
+# Span ativo na thread/contexto atual: (trace_id, span_id)
+_current = ContextVar("llm_trace_current", default=None)
+
+
+def new_request_id():
+    return uuid.uuid4().hex
+
+
+def valid_request_id(value):
+    return bool(value) and _ID_PATTERN.fullmatch(value) is not None
+
+
+def current_request_id():
+    current = _current.get()
+    return current[0] if current else None
+
+
+class Span:
+    """Span em curso. end() escreve-o; set() acrescenta atributos."""
+
+    __slots__ = ("tracer", "trace_id", "span_id", "parent", "name", "attrs", "start", "_started_at", "_token", "_ended")
+
+    def __init__(self, tracer, trace_id, parent, name, attrs):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent = parent
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self._started_at = time.monotonic()
+        self._token = None
+        self._ended = False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def activate(self):
+        """Torna este span o pai dos seguintes no contexto atual."""
+        self._token = _current.set((self.trace_id, self.span_id))
+        return self
+
+    def end(self, status="ok"):
+        if self._ended: return
+        self._ended = True
+        if self._token is not None:
+            try:
+                _current.reset(self._token)
+            except ValueError:
+                # Terminado noutro contexto (ex: fim de um stream): basta limpar o atual
+                _current.set(None)
+        self.tracer.write(self, time.monotonic() - self._started_at, status)
+
+
+class Tracer:
+    """
+    Escritor de spans de um serviço. Sem ficheiro (path vazio) ou sem pedido rastreado, todas
+    as operações são no-op. Escreve uma linha por span em modo append (seguro entre processos).
+    """
+
+    def __init__(self, path, service, max_bytes=TRACE_MAX_BYTES):
+        self.path = path
+        self.service = service
+        self.max_bytes = max_bytes
+        self.enabled = bool(path)
+        self._lock = threading.Lock()
+        self.written = 0
+        self.errors = 0
+
+    def begin(self, name, trace_id=None, **attrs):
+        """
+        Abre um span e torna-o o atual. Sem trace_id usa o pedido em curso (filho do span atual);
+        com trace_id começa/continua esse pedido (raiz de um serviço). Devolve None sem pedido.
+        """
+        target = self._target(trace_id)
+        if target is None: return None
+        return Span(self, *target, name, attrs).activate()
+
+    def _target(self, trace_id):
+        """(pedido, span pai) de um span novo, ou None se não houver nada a rastrear."""
+        if not self.enabled: return None
+        current = _current.get()
+        if trace_id is None: return current
+        return trace_id, (current[1] if current and current[0] == trace_id else None)
+
+    @contextmanager
+    def span(self, name, trace_id=None, **attrs):
+        span = self.begin(name, trace_id, **attrs)
+        if span is None:
+            yield None
+            return
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error=type(e).__name__)
+            span.end("error")
+            raise
+        span.end()
+
+    def record(self, name, duration, status="ok", trace_id=None, **attrs):
+        """
+        Span já terminado (ex: espera medida por outro componente), a acabar agora. Sem trace_id é
+        filho do span atual; com trace_id (ex: motores no SearXNG, sem contexto) fica nesse pedido.
+        """
+        target = self._target(trace_id)
+        if target is None: return
+        span = Span(self, *target, name, attrs)
+        span.start -= duration
+        span._ended = True
+        self.write(span, duration, status)
+
+    def event(self, name, **attrs):
+        """Marco instantâneo (ex: primeiro token) no pedido em curso."""
+        self.record(name, 0.0, **attrs)
+
+    def write(self, span, duration, status):
+        line = json.dumps({
+            "trace": span.trace_id, "span": span.span_id, "parent": span.parent,
+            "service": self.service, "name": span.name,
+            "start": round(span.start, 6), "duration": round(duration, 6),
+            "status": status, "attrs": span.attrs
+        }, ensure_ascii=False, default=str) + "\n"
+        try:
+            with self._lock:
+                self._rotate()
+                # Uma única escrita O_APPEND por linha: linhas de vários processos não se misturam
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, line.encode("utf-8"))
+                finally:
+                    os.close(fd)
+                self.written += 1
+        except OSError as e:
+            self.errors += 1
+            if self.errors == 1: logger.warning(f"Erro a escrever spans em {self.path}: {e}")
+
+    def _rotate(self):
+        if not self.max_bytes or self.written % 256: return
+        try:
+            if os.path.getsize(self.path) > self.max_bytes:
+                os.replace(self.path, self.path + ".1")
+        except OSError:
+            pass
+
+    def snapshot(self):
+        return {"enabled": self.enabled, "file": self.path, "service": self.service, "written": self.written, "errors": self.errors}
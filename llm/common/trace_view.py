@@ -0,0 +1,140 @@
+"""
+Cascata (waterfall) de um pedido a partir dos ficheiros de spans do llm_trace.
+
+Junta os ficheiros de vários serviços (chat_proxy, motores do SearXNG, search_api.py) e mostra,
+para um X-Request-ID, cada span com o início relativo ao pedido, a duração e uma barra.
+Os spans sem pai conhecido (ex: de outro serviço) ficam pendurados na raiz do pedido.
+
+Uso:
+    python trace_view.py --list                                   # Pedidos mais recentes
+    python trace_view.py --slowest 10                             # Pedidos mais lentos
+    python trace_view.py 3f2a9c...                                # Cascata de um pedido (ou prefixo do ID)
+    python trace_view.py 3f2a9c... -f /var/log/llm-trace/*.jsonl  # Outros ficheiros de spans
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from collections import defaultdict
+
+DEFAULT_FILES = [f for f in os.getenv("TRACE_FILES", os.getenv("TRACE_FILE", "")).split(",") if f]
+BAR_WIDTH = 40
+
+def load_spans(paths):
+    """Spans de todos os ficheiros (e das cópias .1 rodadas), agrupados por pedido."""
+    traces = defaultdict(list)
+    for path in paths:
+        for candidate in (path + ".1", path):
+            if not os.path.exists(candidate): continue
+            with open(candidate, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        span = json.loads(line)
+                    except ValueError:
+                        continue
+                    if span.get("trace"): traces[span["trace"]].append(span)
+    return traces
+
+def trace_bounds(spans):
+    start = min(s["start"] for s in spans)
+    end = max(s["start"] + s["duration"] for s in spans)
+    return start, end
+
+def find_trace(traces, request_id):
+    if request_id in traces: return request_id
+    matches = [trace_id for trace_id in traces if trace_id.startswith(request_id)]
+    if len(matches) > 1: raise SystemExit(f"Prefixo ambíguo: {len(matches)} pedidos começam por '{request_id}'.")
+    return matches[0] if matches else None
+
+def order_spans(spans):
+    """Percurso em profundidade (filhos por ordem de início). Devolve [(profundidade, span)]."""
+    ids = {s["span"] for s in spans}
+    children = defaultdict(list)
+    roots = []
+    for span in spans:
+        if span.get("parent") in ids: children[span["parent"]].append(span)
+        else: roots.append(span)
+    roots.sort(key=lambda s: (s["start"], -s["duration"]))
+    # Raiz do pedido: o span mais antigo sem pai; os restantes órfãos ficam por baixo dela
+    main, orphans = roots[0], roots[1:]
+    children[main["span"]].extend(orphans)
+
+    ordered = []
+    def visit(span, depth):
+        ordered.append((depth, span))
+        for child in sorted(children[span["span"]], key=lambda s: (s["start"], -s["duration"])):
+            visit(child, depth + 1)
+    visit(main, 0)
+    return ordered
+
+def bar(offset, duration, total, width=BAR_WIDTH):
+    if total <= 0: return "|"
+    begin = min(width - 1, int(offset / total * width))
+    length = max(1, int(round(duration / total * width)))
+    return " " * begin + ("█" * min(length, width - begin) if duration else "◆")
+
+def describe(span):
+    attrs = " ".join(f"{k}={v}" for k, v in (span.get("attrs") or {}).items())
+    status = "" if span.get("status", "ok") == "ok" else f" [{span['status'].upper()}]"
+    return f"{span['name']}{status}" + (f" ({attrs})" if attrs else "")
+
+def render(trace_id, spans):
+    start, end = trace_bounds(spans)
+    total = end - start
+    services = sorted({s["service"] for s in spans})
+    print(f"Pedido {trace_id}  {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start))}  "
+          f"total {total:.3f}s  {len(spans)} spans  serviços: {', '.join(services)}")
+    width = max(len("  " * depth + f"[{s['service']}] ") for depth, s in order_spans(spans))
+    for depth, span in order_spans(spans):
+        offset = span["start"] - start
+        label = "  " * depth + f"[{span['service']}] "
+        print(f"{offset:8.3f}s {span['duration']:8.3f}s  {label:{width}s}|{bar(offset, span['duration'], total):{BAR_WIDTH}s}|  {describe(span)}")
+
+def summaries(traces):
+    rows = []
+    for trace_id, spans in traces.items():
+        start, end = trace_bounds(spans)
+        root = min(spans, key=lambda s: (s["start"], -s["duration"]))
+        errors = sum(1 for s in spans if s.get("status", "ok") != "ok")
+        rows.append((start, end - start, trace_id, root["name"], len(spans), errors))
+    return rows
+
+def print_summaries(rows):
+    for start, total, trace_id, name, count, errors in rows:
+        flag = f"  {errors} erro(s)" if errors else ""
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start))}  {total:8.3f}s  {trace_id}  {name}  ({count} spans){flag}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Cascata de spans de um pedido (llm_trace)")
+    parser.add_argument("request_id", nargs="?", help="X-Request-ID (ou prefixo) do pedido")
+    parser.add_argument("-f", "--file", action="append", help="Ficheiro de spans (repetível; padrão: TRACE_FILES/TRACE_FILE)")
+    parser.add_argument("--list", type=int, nargs="?", const=20, metavar="N", help="Os N pedidos mais recentes")
+    parser.add_argument("--slowest", type=int, metavar="N", help="Os N pedidos mais lentos")
+    args = parser.parse_args()
+
+    paths = args.file or DEFAULT_FILES
+    if not paths:
+        parser.error("Sem ficheiros de spans: usar -f ou definir TRACE_FILE/TRACE_FILES.")
+    traces = load_spans(paths)
+    if not traces:
+        print("Nenhum span encontrado.")
+        return 1
+
+    if args.request_id:
+        trace_id = find_trace(traces, args.request_id)
+        if trace_id is None:
+            print(f"Pedido '{args.request_id}' não encontrado.")
+            return 1
+        render(trace_id, traces[trace_id])
+        return 0
+
+    rows = summaries(traces)
+    if args.slowest:
+        print_summaries(sorted(rows, key=lambda r: -r[1])[:args.slowest])
+    else:
+        print_summaries(sorted(rows)[-(args.list or 20):])
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
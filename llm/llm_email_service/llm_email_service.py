@@ -17,6 +17,10 @@ import os
 import sys
 import re
 
+# Descodificador de streams partilhado com o chat_proxy (llm/common; noutra localização, LLM_COMMON_DIR)
+sys.path.insert(0, os.getenv("LLM_COMMON_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common")))
+from llm_stream import StreamDecoder, aiter_deltas
+
 # --- Configuração de Logging ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 log = logging.getLogger('llm-email-service')
@@ -161,16 +165,10 @@ async def call_llm(user_text, system_context=None):
         async with httpx.AsyncClient(timeout=LLM_TIMEOUT) as client:
             async with client.stream("POST", LLM_API_URL, headers=headers, json=payload) as response:
                 if response.status_code != 200: return None
-                full_text = ""
-                async for line in response.aiter_lines():
-                    if line.startswith("data: "):
-                        json_str = line[6:]
-                        if json_str.strip() == "[DONE]": break
-                        try:
-                            chunk = json.loads(json_str)
-                            content = chunk['choices'][0].get('delta', {}).get('content', '')
-                            if content: full_text += content
-                        except: continue
+                decoder = StreamDecoder()
+                async for _ in aiter_deltas(response.aiter_bytes(), decoder): pass
+                if decoder.errors: log.warning(f"Stream LLM com {decoder.errors} linha(s) inválida(s).")
+                full_text = decoder.text()
                 return full_text if full_text else None
     except Exception as e:
         log.error(f"Erro LLM: {e}")
@@ -6,6 +6,9 @@ import urllib.parse
 import json
 import datetime
 import re
+import os
+import sys
+import contextlib
 from elasticsearch import Elasticsearch
 
 # --- Configuração ---
@@ -35,8 +38,23 @@ PATTERNS_TO_HIDE = [
     r"https://keysender\.linuxkafe\.com/lounge\.php\?\S+",
     r"https://filesender\.linuxkafe\.com/\?s=download\S+"
 ]
+
+# Spans dos pedidos com X-Request-ID (enviado pelo motor tickets), lidos pelo trace_view.py (vazio desativa)
+TRACE_FILE = "/var/log/llm-trace/search_api_spans.jsonl"
 # ---------------------------------------------
 
+# Rastreio partilhado com o chat_proxy (llm/common/llm_trace.py, ou LLM_COMMON_DIR). Opcional.
+sys.path.insert(0, os.getenv("LLM_COMMON_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common")))
+try:
+    from llm_trace import TRACE_HEADER, Tracer, valid_request_id
+    tracer = Tracer(TRACE_FILE, "search_api")
+except ImportError:
+    TRACE_HEADER, tracer = "X-Request-ID", None
+
+
+def trace_span(name, **attrs):
+    return tracer.span(name, **attrs) if tracer else contextlib.nullcontext()
+
 
 # Inicializa o cliente Elasticsearch
 try:
@@ -50,7 +68,29 @@ except Exception as e:
 
 
 class MyHandler(http.server.SimpleHTTPRequestHandler):
+    request_id = None
+    status_code = None
+
     def do_GET(self):
+        # ID do pedido do chat_proxy: devolvido na resposta e usado nos spans desta API
+        request_id = self.headers.get(TRACE_HEADER, '')
+        self.request_id = request_id if tracer and valid_request_id(request_id) else None
+        self.status_code = None
+        span = tracer.begin("search_api.request", self.request_id) if self.request_id else None
+        try:
+            self.handle_search()
+        finally:
+            if span:
+                span.set(status_code=self.status_code)
+                span.end("error" if (self.status_code or 500) >= 500 else "ok")
+
+    def send_response(self, code, message=None):
+        self.status_code = code
+        super().send_response(code, message)
+        if self.request_id:
+            self.send_header(TRACE_HEADER, self.request_id)
+
+    def handle_search(self):
         try:
             # --- VERIFICAÇÃO DA API KEY ---
             received_key = self.headers.get('X-API-Key')
@@ -140,7 +180,8 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
             # ---------------------------------------------
 
             # (4) Executa a pesquisa
-            response = es.search(index=ES_INDEX, body=es_query_dsl)
+            with trace_span("elasticsearch.search", index=ES_INDEX):
+                response = es.search(index=ES_INDEX, body=es_query_dsl)
 
             # --- Formata a resposta para o SearXNG (COM PRIORIDADE INVERTIDA) ---
             results_list = []
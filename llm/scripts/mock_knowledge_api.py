@@ -0,0 +1,141 @@
+"""
+Mock local da API de conhecimento do Open WebUI, para testar o sync_faq.py sem tocar na coleção real.
+
+Implementa só o que o sync usa, com estado em memória:
+    GET  /api/v1/knowledge/{id}              -> {"id", "files": [{"id", "meta": {"name"}}]}
+    POST /api/v1/files/                      (multipart, campo "file") -> {"id", "filename", "meta"}
+    POST /api/v1/knowledge/{id}/file/add     {"file_id"}
+    POST /api/v1/knowledge/{id}/file/remove  {"file_id"}
+    GET  /_stats                             -> contagem de chamadas por operação (para os testes)
+
+Uso:
+    python mock_knowledge_api.py --port 8765 --fail-rate 0.1 --latency 0.05
+    OPENWEBUI_URL=http://127.0.0.1:8765 OPENWEBUI_API_KEY=teste KNOWLEDGE_ID=faq python sync_faq.py --sqlite faq.db
+"""
+import re
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from collections import Counter
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class KnowledgeStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}        # file_id -> {"name", "content"}
+        self.knowledge = {}    # knowledge_id -> [file_id, ...]
+        self.calls = Counter()
+
+class MockHandler(BaseHTTPRequestHandler):
+    store = None
+    api_key = None
+    fail_rate = 0.0
+    latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _guard(self, operation):
+        """Autenticação, latência e falhas simuladas. Devolve False se o pedido já foi respondido."""
+        self.store.calls[operation] += 1
+        if self.api_key and self.headers.get("Authorization") != f"Bearer {self.api_key}":
+            self._send(401, {"detail": "Not authenticated"})
+            return False
+        if self.latency: time.sleep(self.latency)
+        if self.fail_rate and random.random() < self.fail_rate:
+            self.store.calls[f"{operation}.failed"] += 1
+            self._send(503, {"detail": "Falha simulada"})
+            return False
+        return True
+
+    def do_GET(self):
+        if self.path == "/_stats":
+            with self.store.lock:
+                return self._send(200, {"calls": dict(self.store.calls), "files": len(self.store.files),
+                                        "knowledge": {k: len(v) for k, v in self.store.knowledge.items()}})
+        match = re.fullmatch(r"/api/v1/knowledge/([^/]+)/?", self.path)
+        if not match: return self._send(404, {"detail": "Not found"})
+        if not self._guard("list"): return
+        with self.store.lock:
+            file_ids = self.store.knowledge.setdefault(match.group(1), [])
+            files = [{"id": fid, "meta": {"name": self.store.files[fid]["name"]}} for fid in file_ids]
+        self._send(200, {"id": match.group(1), "files": files})
+
+    def do_POST(self):
+        if self.path.rstrip("/") == "/api/v1/files":
+            return self._upload()
+        match = re.fullmatch(r"/api/v1/knowledge/([^/]+)/file/(add|remove)", self.path)
+        if not match: return self._send(404, {"detail": "Not found"})
+        knowledge_id, action = match.groups()
+        body = self._body()
+        if not self._guard(action): return
+        try:
+            file_id = json.loads(body)["file_id"]
+        except (ValueError, KeyError, TypeError):
+            return self._send(422, {"detail": "file_id em falta"})
+        with self.store.lock:
+            file_ids = self.store.knowledge.setdefault(knowledge_id, [])
+            if file_id not in self.store.files: return self._send(400, {"detail": "File not found"})
+            if action == "add":
+                if file_id in file_ids: return self._send(400, {"detail": "Duplicate content detected"})
+                file_ids.append(file_id)
+            else:
+                if file_id not in file_ids: return self._send(400, {"detail": "File not found in knowledge"})
+                file_ids.remove(file_id)
+                del self.store.files[file_id]
+            files = [{"id": fid, "meta": {"name": self.store.files[fid]["name"]}} for fid in file_ids]
+        self._send(200, {"id": knowledge_id, "files": files})
+
+    def _upload(self):
+        body = self._body()
+        if not self._guard("upload"): return
+        # Multipart lido com o parser de email (o cgi saiu da biblioteca padrão)
+        message = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {self.headers.get('Content-Type', '')}\r\n\r\n".encode("latin-1") + body)
+        part = next((p for p in message.iter_parts() if p.get_param("name", header="content-disposition") == "file"), None) \
+            if message.is_multipart() else None
+        if part is None: return self._send(422, {"detail": "Campo 'file' em falta"})
+        name = part.get_filename() or "upload.txt"
+        file_id = str(uuid.uuid4())
+        with self.store.lock:
+            self.store.files[file_id] = {"name": name, "content": part.get_payload(decode=True).decode("utf-8", "replace")}
+        self._send(200, {"id": file_id, "filename": name, "meta": {"name": name}})
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock da API de conhecimento do Open WebUI")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--api-key", help="Se definida, exige 'Authorization: Bearer <chave>'")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Fração de pedidos que devolvem 503")
+    parser.add_argument("--latency", type=float, default=0.0, help="Atraso por pedido (segundos)")
+    args = parser.parse_args()
+
+    MockHandler.store = KnowledgeStore()
+    MockHandler.api_key = args.api_key
+    MockHandler.fail_rate = args.fail_rate
+    MockHandler.latency = args.latency
+    server = ThreadingHTTPServer((args.host, args.port), MockHandler)
+    print(f"Mock da API de conhecimento em http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
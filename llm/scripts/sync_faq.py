@@ -0,0 +1,419 @@
+"""
+Sincronização incremental das FAQ do OTOBO com a coleção de conhecimento do Open WebUI e
+com a knowledge_base.json do chat_proxy (substitui o sync-faq-perl.pl).
+
+Cada FAQ tem um hash do conteúdo exportado. Só as FAQ novas ou alteradas são enviadas; as
+apagadas (ou ficheiros faq_<id>.txt que não são nossos) são retirados da coleção. O estado
+(FAQ -> hash, file_id) fica em SYNC_FAQ_STATE. Os uploads correm em paralelo
+(SYNC_FAQ_CONCURRENCY); as alterações à lista de ficheiros da coleção são feitas uma a uma,
+porque o Open WebUI atualiza essa lista com leitura-modificação-escrita.
+
+Na mesma passagem escreve a knowledge_base.json (conteúdo + triggers derivados do título e
+das palavras-chave), de forma atómica e só se mudar. As entradas sem "faq_id" (manuais) são mantidas.
+
+Uso:
+    python sync_faq.py                                  # MySQL do OTOBO (~/.my.cnf) -> Open WebUI + KB
+    python sync_faq.py --dry-run                        # Mostra o plano sem alterar nada
+    python sync_faq.py --kb-only                        # Só a knowledge_base.json
+    python sync_faq.py --sqlite faq.db                  # Cópia local em SQLite (testes)
+    python sync_faq.py --export-sqlite faq.db           # Cria essa cópia a partir do MySQL
+    OPENWEBUI_URL=http://127.0.0.1:8765 python sync_faq.py --sqlite faq.db   # Com o mock_knowledge_api.py
+"""
+import os
+import re
+import sys
+import json
+import html
+import time
+import hashlib
+import logging
+import sqlite3
+import argparse
+import tempfile
+import unicodedata
+from collections import Counter
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import httpx
+
+# ==============================================================================
+# 1. CONFIGURAÇÃO
+# ==============================================================================
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('SyncFAQ')
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+OPENWEBUI_URL = os.getenv("OPENWEBUI_URL", "https://linuxkafe.com").rstrip("/")
+OPENWEBUI_API_KEY = os.getenv("OPENWEBUI_API_KEY", "")
+KNOWLEDGE_ID = os.getenv("KNOWLEDGE_ID", "")
+
+# Base de dados do OTOBO (credenciais em ~/.my.cnf, como no script Perl)
+OTOBO_DB_NAME = os.getenv("OTOBO_DB_NAME", "otobo")
+MYSQL_DEFAULTS_FILE = os.getenv("MYSQL_DEFAULTS_FILE", os.path.expanduser("~/.my.cnf"))
+
+SYNC_FAQ_STATE = os.getenv("SYNC_FAQ_STATE", "/var/lib/faq-sync/state.json")
+SYNC_FAQ_KB_FILE = os.getenv("SYNC_FAQ_KB_FILE", "/opt/chat-proxy/knowledge_base.json")
+# Uploads em paralelo e tentativas por chamada (espera 1s, 2s, ... entre tentativas)
+SYNC_FAQ_CONCURRENCY = int(os.getenv("SYNC_FAQ_CONCURRENCY", 4))
+SYNC_FAQ_RETRIES = int(os.getenv("SYNC_FAQ_RETRIES", 3))
+SYNC_FAQ_RETRY_DELAY = float(os.getenv("SYNC_FAQ_RETRY_DELAY", 1.0))
+SYNC_FAQ_TIMEOUT = float(os.getenv("SYNC_FAQ_TIMEOUT", 120))
+# Palavras do título presentes em mais do que esta fração das FAQ não são triggers (pouco distintivas)
+SYNC_FAQ_TRIGGER_MAX_DF = float(os.getenv("SYNC_FAQ_TRIGGER_MAX_DF", 0.05))
+
+FAQ_QUERY = "SELECT id, f_subject, f_keywords, f_field1, f_field2, f_field3, f_field4, f_field5, f_field6 FROM faq_item"
+FAQ_COLUMNS = ("id", "f_subject", "f_keywords", "f_field1", "f_field2", "f_field3", "f_field4", "f_field5", "f_field6")
+# Alterar quando o formato exportado mudar: força o reenvio de todas as FAQ
+EXPORT_VERSION = "1"
+FAQ_FILENAME = re.compile(r"faq_(\d+)\.txt$")
+
+# Palavras que nunca são triggers por si só
+STOPWORDS = {
+    'a', 'o', 'as', 'os', 'um', 'uma', 'de', 'do', 'da', 'dos', 'das', 'em', 'no', 'na', 'nos', 'nas',
+    'ao', 'aos', 'para', 'por', 'pelo', 'pela', 'com', 'sem', 'e', 'ou', 'que', 'se', 'como', 'onde',
+    'qual', 'quais', 'quando', 'meu', 'minha', 'seu', 'sua', 'ser', 'faq', 'up', 'pt', 'the', 'to', 'how',
+}
+
+class SyncError(Exception):
+    pass
+
+# ==============================================================================
+# 2. FAQ (BASE DE DADOS)
+# ==============================================================================
+
+def clean_content(text):
+    """Mesma limpeza do script Perl: entidades, HTML, bullets e espaços."""
+    text = html.unescape(text or "")
+    text = re.sub(r'<[^>]*>', '', text)
+    text = text.replace('•', '')
+    text = re.sub(r'\\[nrt]', ' ', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+def normalize_text(text):
+    # Igual ao normalize_text do chat_proxy (os triggers são comparados assim)
+    if not text: return ""
+    text = text.lower().strip()
+    text = ''.join(c for c in unicodedata.normalize('NFD', text) if unicodedata.category(c) != 'Mn')
+    text = re.sub(r'[^\w\s]', '', text)
+    return re.sub(r'\s+', ' ', text)
+
+def faq_hash(content):
+    return hashlib.sha256(f"{EXPORT_VERSION}\n{content}".encode("utf-8")).hexdigest()
+
+def load_faq_rows(conn):
+    cursor = conn.cursor()
+    cursor.execute(FAQ_QUERY)
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
+def build_items(rows):
+    """{faq_id: item} com o texto exportado (título + campos) e o seu hash. FAQ vazias são ignoradas."""
+    items = {}
+    for faq_id, subject, keywords, *fields in rows:
+        subject = clean_content(subject)
+        content = clean_content(" ".join([subject] + [f or "" for f in fields]))
+        if not content:
+            logger.warning(f"Ignorada (vazia): '{subject}' (ID: {faq_id})")
+            continue
+        items[int(faq_id)] = {
+            "id": int(faq_id), "subject": subject, "keywords": keywords or "",
+            "content": content, "hash": faq_hash(content), "name": f"faq_{int(faq_id)}.txt"
+        }
+    return items
+
+def connect_mysql():
+    # Dependência apenas do modo MySQL: os testes com --sqlite não precisam dela
+    import pymysql
+    return pymysql.connect(database=OTOBO_DB_NAME, read_default_file=MYSQL_DEFAULTS_FILE, charset="utf8mb4")
+
+def export_sqlite(rows, path):
+    """Cópia local da tabela faq_item (só as colunas usadas) para testes."""
+    if os.path.exists(path): os.unlink(path)
+    conn = sqlite3.connect(path)
+    conn.execute(f"CREATE TABLE faq_item ({', '.join(FAQ_COLUMNS)})")
+    conn.executemany(f"INSERT INTO faq_item VALUES ({', '.join('?' * len(FAQ_COLUMNS))})", rows)
+    conn.commit()
+    conn.close()
+
+# ==============================================================================
+# 3. KNOWLEDGE_BASE.JSON DO CHAT_PROXY
+# ==============================================================================
+
+def split_keywords(keywords):
+    # O OTOBO separa palavras-chave por espaços; vírgulas/ponto e vírgula delimitam expressões
+    parts = re.split(r'[,;]', keywords) if re.search(r'[,;]', keywords) else keywords.split()
+    return [normalize_text(p) for p in parts if normalize_text(p)]
+
+def subject_tokens(subject):
+    return [t for t in normalize_text(subject).split() if t not in STOPWORDS and len(t) > 2 and not t.isdigit()]
+
+def derive_triggers(item, doc_freq, max_df):
+    """
+    Triggers de uma FAQ: palavras-chave do OTOBO, o título (se curto), pares de palavras
+    seguidas do título e as palavras distintivas do título (raras entre as FAQ).
+    """
+    triggers = split_keywords(item["keywords"])
+    tokens = subject_tokens(item["subject"])
+    title = normalize_text(item["subject"])
+    if 1 < len(title.split()) <= 6: triggers.append(title)
+    triggers.extend(f"{a} {b}" for a, b in zip(tokens, tokens[1:]))
+    triggers.extend(t for t in tokens if doc_freq[t] <= max_df)
+    return list(dict.fromkeys(t for t in triggers if t))
+
+def build_kb_entries(items, max_df_ratio=SYNC_FAQ_TRIGGER_MAX_DF):
+    doc_freq = Counter(t for item in items.values() for t in set(subject_tokens(item["subject"])))
+    max_df = max(2, int(max_df_ratio * len(items)))
+    return [
+        {
+            "faq_id": item["id"],
+            "title": item["subject"],
+            "triggers": derive_triggers(item, doc_freq, max_df),
+            "content": item["content"],
+        }
+        for item in sorted(items.values(), key=lambda i: i["id"])
+    ]
+
+def write_json_atomic(path, data):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path): os.unlink(tmp_path)
+        raise
+
+def update_kb_file(path, faq_entries):
+    """
+    Substitui as entradas das FAQ mantendo as manuais. Só reescreve se o conteúdo mudar:
+    o chat_proxy invalida as respostas em cache quando a KB muda (mtime).
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            current = json.load(f)
+    except FileNotFoundError:
+        current = []
+    manual = [entry for entry in current if "faq_id" not in entry]
+    updated = manual + faq_entries
+    if updated == current:
+        logger.info(f"{path} sem alterações ({len(faq_entries)} FAQ, {len(manual)} entradas manuais).")
+        return False
+    write_json_atomic(path, updated)
+    logger.info(f"{path} atualizado: {len(faq_entries)} FAQ, {len(manual)} entradas manuais.")
+    return True
+
+# ==============================================================================
+# 4. API DE CONHECIMENTO (OPEN WEBUI)
+# ==============================================================================
+
+class KnowledgeAPI:
+    def __init__(self, base_url, api_key, knowledge_id, retries, retry_delay, timeout):
+        self.base_url = base_url
+        self.knowledge_id = knowledge_id
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.client = httpx.Client(
+            headers={"Authorization": f"Bearer {api_key}", "Accept": "application/json", "User-Agent": "SyncFAQ/2.0"},
+            timeout=timeout
+        )
+
+    def _call(self, method, path, **kwargs):
+        """Pedido com novas tentativas (backoff) em erros de rede, 429 e 5xx. Devolve a resposta final."""
+        url = f"{self.base_url}{path}"
+        for attempt in range(1, self.retries + 1):
+            try:
+                resp = self.client.request(method, url, **kwargs)
+                if resp.status_code != 429 and resp.status_code < 500: return resp
+                error = f"HTTP {resp.status_code}"
+            except httpx.HTTPError as e:
+                resp, error = None, str(e)
+            logger.warning(f"{method} {path} falhou ({error}), tentativa {attempt}/{self.retries}.")
+            if attempt < self.retries: time.sleep(self.retry_delay * 2 ** (attempt - 1))
+        if resp is None: raise SyncError(f"{method} {path}: {error}")
+        return resp
+
+    @staticmethod
+    def _detail(resp):
+        try:
+            return str(resp.json().get("detail") or "")
+        except (ValueError, AttributeError):
+            return resp.text[:200]
+
+    def list_files(self):
+        """{file_id: nome} dos ficheiros da coleção."""
+        resp = self._call("GET", f"/api/v1/knowledge/{self.knowledge_id}")
+        if not resp.is_success: raise SyncError(f"Listagem da coleção: HTTP {resp.status_code} {self._detail(resp)}")
+        files = resp.json().get("files") or []
+        return {f["id"]: (f.get("meta") or {}).get("name") or f.get("filename") or "" for f in files if f.get("id")}
+
+    def upload(self, name, content):
+        resp = self._call("POST", "/api/v1/files/", files={"file": (name, content.encode("utf-8"), "text/plain")})
+        if not resp.is_success: raise SyncError(f"Upload {name}: HTTP {resp.status_code} {self._detail(resp)}")
+        file_id = (resp.json() or {}).get("id")
+        if not file_id: raise SyncError(f"Upload {name}: resposta sem id")
+        return file_id
+
+    def add(self, file_id):
+        resp = self._call("POST", f"/api/v1/knowledge/{self.knowledge_id}/file/add", json={"file_id": file_id})
+        if resp.is_success or re.search(r"duplicate|already exists", self._detail(resp), re.I): return
+        raise SyncError(f"Adicionar {file_id}: HTTP {resp.status_code} {self._detail(resp)}")
+
+    def remove(self, file_id):
+        resp = self._call("POST", f"/api/v1/knowledge/{self.knowledge_id}/file/remove", json={"file_id": file_id})
+        if resp.is_success or re.search(r"not found", self._detail(resp), re.I): return
+        raise SyncError(f"Remover {file_id}: HTTP {resp.status_code} {self._detail(resp)}")
+
+# ==============================================================================
+# 5. SINCRONIZAÇÃO
+# ==============================================================================
+
+def load_state(path, knowledge_id):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    # Estado de outra coleção não serve: tudo é reenviado
+    if state.get("knowledge_id") != knowledge_id: return {}
+    return {int(faq_id): entry for faq_id, entry in state.get("items", {}).items()}
+
+def save_state(path, knowledge_id, tracked):
+    write_json_atomic(path, {
+        "knowledge_id": knowledge_id, "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "items": {str(faq_id): entry for faq_id, entry in sorted(tracked.items())}
+    })
+
+def plan_sync(items, state, remote):
+    """
+    Compara FAQ, estado e coleção. Devolve (uploads, replaces, removals, unchanged):
+    uploads/replaces são listas de FAQ; removals são file_ids; unchanged é {faq_id: entrada}.
+    """
+    uploads, replaces, unchanged = [], [], {}
+    for faq_id, item in items.items():
+        entry = state.get(faq_id)
+        if entry and entry.get("file_id") in remote:
+            if entry.get("hash") == item["hash"]: unchanged[faq_id] = entry
+            else: replaces.append(item)
+        else:
+            uploads.append(item)
+
+    # Na coleção e não acompanhados: FAQ apagadas, versões antigas e ficheiros do script Perl
+    kept = {entry["file_id"] for faq_id, entry in state.items() if faq_id in items and entry.get("file_id") in remote}
+    removals = []
+    for file_id, name in remote.items():
+        if file_id in kept: continue
+        if FAQ_FILENAME.search(name or ""): removals.append(file_id)
+        else: logger.info(f"Ficheiro '{name}' ({file_id}) não é uma FAQ: mantido.")
+    # Numa substituição o ficheiro antigo só sai depois de o novo estar na coleção
+    replaced_old = {state[item["id"]]["file_id"] for item in replaces}
+    removals = [file_id for file_id in removals if file_id not in replaced_old]
+    return uploads, replaces, removals, unchanged
+
+def sync(api, items, state, concurrency, dry_run=False):
+    remote = api.list_files()
+    uploads, replaces, removals, unchanged = plan_sync(items, state, remote)
+    logger.info(f"Plano: {len(uploads)} novas, {len(replaces)} alteradas, {len(removals)} a remover, {len(unchanged)} sem alterações.")
+    summary = Counter(unchanged=len(unchanged))
+    if dry_run:
+        for item in uploads: print(f"novo      {item['name']}  {item['subject'][:70]}")
+        for item in replaces: print(f"alterado  {item['name']}  {item['subject'][:70]}")
+        for file_id in removals: print(f"remover   {remote[file_id]}  ({file_id})")
+        return summary, unchanged
+
+    tracked = dict(unchanged)
+    kb_lock = Lock()
+
+    def push(item, old_file_id=None):
+        # Upload (extração do texto no Open WebUI) em paralelo; alterações à coleção uma a uma
+        file_id = api.upload(item["name"], item["content"])
+        with kb_lock:
+            api.add(file_id)
+            if old_file_id: api.remove(old_file_id)
+        return {"hash": item["hash"], "file_id": file_id, "name": item["name"]}
+
+    def drop(file_id):
+        with kb_lock:
+            api.remove(file_id)
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = {executor.submit(push, item): ("uploaded", item) for item in uploads}
+        futures.update({executor.submit(push, item, state[item["id"]]["file_id"]): ("replaced", item) for item in replaces})
+        futures.update({executor.submit(drop, file_id): ("removed", file_id) for file_id in removals})
+        for future in as_completed(futures):
+            action, target = futures[future]
+            try:
+                entry = future.result()
+            except Exception as e:
+                summary["failed"] += 1
+                logger.error(f"Falha ({action}) {target['name'] if isinstance(target, dict) else target}: {e}")
+                continue
+            summary[action] += 1
+            if entry: tracked[target["id"]] = entry
+
+    # Verificação: o que não ficou na coleção volta a ser enviado na próxima execução
+    remote_after = api.list_files()
+    missing = [faq_id for faq_id, entry in tracked.items() if entry["file_id"] not in remote_after]
+    for faq_id in missing: del tracked[faq_id]
+    if missing:
+        summary["missing"] = len(missing)
+        logger.warning(f"{len(missing)} FAQ não aparecem na coleção após a sincronização: serão reenviadas.")
+    return summary, tracked
+
+# ==============================================================================
+# 6. EXECUÇÃO
+# ==============================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Sincronização incremental das FAQ do OTOBO (Open WebUI + knowledge_base.json)")
+    parser.add_argument("--sqlite", help="Lê as FAQ desta cópia SQLite em vez do MySQL do OTOBO")
+    parser.add_argument("--export-sqlite", metavar="FICHEIRO", help="Copia a tabela faq_item do MySQL para SQLite e termina")
+    parser.add_argument("--kb-file", default=SYNC_FAQ_KB_FILE, help="knowledge_base.json do chat_proxy")
+    parser.add_argument("--state", default=SYNC_FAQ_STATE, help="Ficheiro de estado (hash e file_id por FAQ)")
+    parser.add_argument("--kb-only", action="store_true", help="Só atualiza a knowledge_base.json")
+    parser.add_argument("--dry-run", action="store_true", help="Mostra o plano sem alterar a coleção nem os ficheiros")
+    parser.add_argument("--concurrency", type=int, default=SYNC_FAQ_CONCURRENCY)
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.sqlite) if args.sqlite else connect_mysql()
+    try:
+        rows = load_faq_rows(conn)
+    finally:
+        conn.close()
+    if args.export_sqlite:
+        export_sqlite(rows, args.export_sqlite)
+        logger.info(f"{len(rows)} FAQ copiadas para {args.export_sqlite}.")
+        return 0
+
+    items = build_items(rows)
+    logger.info(f"{len(items)} FAQ com conteúdo ({len(rows)} na base de dados).")
+    if not items:
+        # Uma base de dados vazia (ou uma query falhada) não pode apagar a coleção inteira
+        logger.error("Nenhuma FAQ lida: nada é alterado.")
+        return 1
+
+    if not args.dry_run: update_kb_file(args.kb_file, build_kb_entries(items))
+    if args.kb_only: return 0
+
+    if not KNOWLEDGE_ID or not OPENWEBUI_API_KEY:
+        logger.error("KNOWLEDGE_ID e OPENWEBUI_API_KEY são obrigatórios (ou usar --kb-only).")
+        return 1
+    api = KnowledgeAPI(OPENWEBUI_URL, OPENWEBUI_API_KEY, KNOWLEDGE_ID, SYNC_FAQ_RETRIES, SYNC_FAQ_RETRY_DELAY, SYNC_FAQ_TIMEOUT)
+    started_at = time.monotonic()
+    try:
+        summary, tracked = sync(api, items, load_state(args.state, KNOWLEDGE_ID), args.concurrency, args.dry_run)
+    except SyncError as e:
+        logger.error(f"Sincronização abortada: {e}")
+        return 1
+    if not args.dry_run: save_state(args.state, KNOWLEDGE_ID, tracked)
+    logger.info(f"Sincronização concluída em {time.monotonic() - started_at:.1f}s: {dict(summary)}")
+    return 1 if summary["failed"] or summary["missing"] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
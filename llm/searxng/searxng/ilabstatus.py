@@ -1,14 +1,24 @@
 # /usr/local/searxng/searx/engines/ilabstatus.py
 
-import json
+import os
 import sys
 import re
-import urllib.parse
+import time
+import json
+import zlib
+import urllib.request
+from functools import lru_cache
 
 # --- CONFIGURAÇÃO ---
 API_URL = "https://status.linuxkafe.com/api/public_status"
 STATUS_PAGE_URL = "https://status.linuxkafe.com"
 
+# Snapshot local escrito pelo status_poller.py (montado no container em modo só de leitura)
+SNAPSHOT_FILE = os.getenv("ILABSTATUS_SNAPSHOT_FILE", "/var/lib/ilabstatus/status_snapshot.json")
+# Idade máxima do snapshot; acima disto o poller é dado como parado e o motor consulta a API diretamente
+SNAPSHOT_MAX_AGE = int(os.getenv("ILABSTATUS_SNAPSHOT_MAX_AGE", 300))
+FALLBACK_TIMEOUT = float(os.getenv("ILABSTATUS_FALLBACK_TIMEOUT", 5))
+
 # --- VOCABULÁRIO (ALIASES) ---
 ALIASES = {
     'wireless': {'wifi', 'wi-fi', 'eduroam', 'internet', 'sem fios', 'wlan', 'conectar', 'lenta', 'falha', 'net', 'ligacao'},
@@ -29,7 +39,15 @@ STATUS_MAP = {
     'planned': 'MANUTENÇÃO AGENDADA'
 }
 
+# Stopwords para limpar URLs (ex: remove 'up', 'pt' de 'pages.up.pt')
+STOPWORDS = {'up', 'pt', 'com', 'br', 'org', 'http', 'https', 'www', 'de', 'do', 'da', 'fe'}
+
+# Gatilhos de Pânico (Só estes ativam o modo "mostrar tudo")
+FORCE_TRIGGERS = {'status', 'estado', 'falha', 'problema', 'down', 'erro', 'avaria'}
+
 # --- METADATA ---
+# Motor offline: o SearXNG chama search() diretamente, sem pedido HTTP por query
+engine_type = 'offline'
 categories = ['it', 'general']
 paging = False
 language_support = False
@@ -42,65 +60,140 @@ about = {
     "results": 'JSON',
 }
 
-def request(query, params):
-    # CORREÇÃO 1: Injeção "Hardcoded" no string do URL
-    # Evita que o dicionário params seja limpo pelo SearXNG
-    safe_query = urllib.parse.quote(query)
-    params['url'] = f"{API_URL}?_track_query={safe_query}"
-    params['method'] = 'GET'
-    return params
-
-def response(resp):
-    if not resp.ok: return []
-    try: data = resp.json()
-    except: return []
-
-    # 1. RECUPERAÇÃO DA QUERY
-    query_raw = ''
-    try:
-        # Tenta ler do URL final da resposta
-        parsed_url = urllib.parse.urlparse(str(resp.url))
-        qs = urllib.parse.parse_qs(parsed_url.query)
-        # O parâmetro agora chama-se '_track_query'
-        query_raw = qs.get('_track_query', [''])[0].lower()
-    except Exception as e:
-        print(f"!!! [ILAB] Erro URL Parse: {e} !!!", file=sys.stderr)
+def search(query, params):
+    index = get_status_index()
+    # FAIL-SAFE (Falha Segura): sem estado conhecido, não mostramos nada
+    if index is None: return []
+
+    # Tudo operacional: nada a mostrar, independentemente da query
+    if not index.alerts: return []
 
-    # CORREÇÃO 2: FAIL-SAFE (Falha Segura)
-    # Se a query vier vazia, ABORTAMOS. Não mostramos nada.
+    query_raw = (query or '').lower()
     if not query_raw:
-        print(f"!!! [ILAB] Query perdida ou vazia. A abortar para evitar falsos positivos. !!!", file=sys.stderr)
+        print(f"!!! [ILAB] Query vazia. A abortar para evitar falsos positivos. !!!", file=sys.stderr)
         return []
 
-    # Stopwords para limpar URLs (ex: remove 'up', 'pt' de 'pages.up.pt')
-    stopwords = {'up', 'pt', 'com', 'br', 'org', 'http', 'https', 'www', 'de', 'do', 'da', 'fe'}
-    
+    tokens = query_tokens(query_raw)
+    # Debug Claro
+    print(f"!!! [ILAB] Query: '{query_raw}' -> Tokens Relevantes: {tokens} !!!", file=sys.stderr)
+    return index.match(tokens, not tokens.isdisjoint(FORCE_TRIGGERS))
+
+def query_tokens(query_raw):
     # Tokenização
     raw_tokens = set(re.split(r'\W+', query_raw))
-    query_tokens = {t for t in raw_tokens if t not in stopwords and len(t) > 1}
+    return {t for t in raw_tokens if t not in STOPWORDS and len(t) > 1}
 
-    # Debug Claro
-    print(f"!!! [ILAB] Query: '{query_raw}' -> Tokens Relevantes: {query_tokens} !!!", file=sys.stderr)
+# --- ÍNDICE POR SNAPSHOT ---
+# O estado só muda quando o feed muda: a árvore é percorrida uma vez por snapshot e cada
+# query passa a ser um punhado de lookups em sets. (impressão digital, índice)
+_status_index = (None, None)
 
-    # Gatilhos de Pânico (Só estes ativam o modo "mostrar tudo")
-    force_triggers = {'status', 'estado', 'falha', 'problema', 'down', 'erro', 'avaria'}
-    
-    # CORREÇÃO 3: Removi o "or query_raw == ''" desta linha
-    show_all = not query_tokens.isdisjoint(force_triggers)
+class StatusIndex:
+    """
+    Índice invertido de um snapshot do estado: palavra-chave/alias -> posições dos alertas
+    (nós não operacionais e incidentes), pela ordem original (incidentes, depois a árvore).
+    """
+
+    def __init__(self, alerts, keywords):
+        self.alerts = alerts
+        self.keywords = keywords
+
+    def match(self, query_tokens, show_all):
+        if show_all: return [dict(alert) for alert in self.alerts]
+        positions = set()
+        for token in query_tokens:
+            positions.update(self.keywords.get(token, ()))
+        return [dict(self.alerts[i]) for i in sorted(positions)]
 
-    results = []
+    def to_dict(self):
+        """Formato do snapshot (também lido pelo kill switch do chat_proxy)."""
+        return {
+            "alerts": self.alerts,
+            "keywords": self.keywords,
+            "stopwords": sorted(STOPWORDS),
+            "force_triggers": sorted(FORCE_TRIGGERS)
+        }
 
-    # 2. PROCESSAMENTO (INCIDENTES)
+    @classmethod
+    def from_dict(cls, snapshot):
+        return cls(snapshot.get("alerts", []), snapshot.get("keywords", {}))
+
+def get_status_index():
+    """Índice do snapshot local; se estiver em falta ou desatualizado, do feed consultado diretamente."""
+    index = load_snapshot_index()
+    if index is not None: return index
+    print(f"!!! [ILAB] Snapshot {SNAPSHOT_FILE} em falta ou desatualizado. A consultar a API. !!!", file=sys.stderr)
+    return fetch_status_index()
+
+def load_snapshot_index():
+    global _status_index
+    try:
+        st = os.stat(SNAPSHOT_FILE)
+    except OSError:
+        return None
+    # O poller atualiza o mtime a cada verificação (mesmo com 304 Not Modified)
+    if time.time() - st.st_mtime > SNAPSHOT_MAX_AGE: return None
+
+    # Cada escrita do poller é um os.replace(): novo inode
+    fingerprint = f"file:{st.st_ino}:{st.st_size}"
+    cached_fingerprint, index = _status_index
+    if fingerprint == cached_fingerprint: return index
+    try:
+        with open(SNAPSHOT_FILE, 'r', encoding='utf-8') as f:
+            index = StatusIndex.from_dict(json.load(f))
+    except (OSError, ValueError) as e:
+        print(f"!!! [ILAB] Snapshot ilegível: {e} !!!", file=sys.stderr)
+        return None
+    # Atribuição de um tuplo: leitores concorrentes veem sempre um par consistente
+    _status_index = (fingerprint, index)
+    return index
+
+def fetch_status_index():
+    # urllib (e não searx.network): o motor também corre dentro do chat_proxy (RETRIEVAL_MODE=inprocess)
+    try:
+        with urllib.request.urlopen(API_URL, timeout=FALLBACK_TIMEOUT) as resp:
+            content = resp.read()
+    except Exception as e:
+        print(f"!!! [ILAB] Erro a consultar a API de estado: {e} !!!", file=sys.stderr)
+        return None
+    return index_from_content(content)
+
+def index_from_content(content):
+    """Índice de um corpo JSON do feed, reconstruído apenas quando o corpo muda. None se o JSON for inválido."""
+    global _status_index
+    # CRC do corpo: muito mais barato do que percorrer a árvore
+    fingerprint = f"crc:{len(content)}:{zlib.crc32(content)}"
+    cached_fingerprint, index = _status_index
+    if fingerprint == cached_fingerprint: return index
+    try: data = json.loads(content)
+    except: return None
+    index = build_status_index(data)
+    _status_index = (fingerprint, index)
+    return index
+
+def build_status_index(data):
+    alerts = []
+    keywords = {}
+
+    def add(item, is_incident=False, override_name=None, override_slug=None):
+        indexed = evaluate_node(item, is_incident, override_name, override_slug)
+        if indexed is None: return
+        alert, item_keywords = indexed
+        for keyword in item_keywords:
+            keywords.setdefault(keyword, []).append(len(alerts))
+        alerts.append(alert)
+
+    # 1. PROCESSAMENTO (INCIDENTES)
     for incident in data.get('incidents', []):
-        evaluate_node(incident, results, query_tokens, show_all, is_incident=True)
+        add(incident, is_incident=True)
 
-    # 3. PROCESSAMENTO (ÁRVORE DE SERVIÇOS)
+    # 2. PROCESSAMENTO (ÁRVORE DE SERVIÇOS)
     for service in data.get('tree', []):
-        traverse_tree(service, results, query_tokens, show_all)
+        traverse_tree(service, add)
 
-    return results
+    return StatusIndex(alerts, keywords)
 
-def traverse_tree(node, results_list, query_tokens, show_all, parent_name=None):
+def traverse_tree(node, add, parent_name=None):
     if not isinstance(node, dict): return
 
     name = node.get('name', 'Serviço')
@@ -108,23 +201,26 @@ def traverse_tree(node, results_list, query_tokens, show_all, parent_name=None):
     full_name = f"{parent_name} > {name}" if parent_name else name
 
     # Avalia este nó
-    evaluate_node(node, results_list, query_tokens, show_all, override_name=full_name, override_slug=slug)
+    add(node, override_name=full_name, override_slug=slug)
 
     # Desce para Grupos
     groups = node.get('groups', [])
     if isinstance(groups, list):
         for group in groups:
-            traverse_tree(group, results_list, query_tokens, show_all, parent_name=full_name)
+            traverse_tree(group, add, parent_name=full_name)
 
     # Desce para Devices
     devices = node.get('devices', [])
     if isinstance(devices, list):
         for device in devices:
-            d_name = device.get('hostname', device.get('name', 'device'))
-            d_fullname = f"{full_name} > {d_name}"
             # Usa o estado do device
             device_status = device.get('state', device.get('status', 'unknown'))
-            
+            # Operacional: nem vale a pena construir o nó
+            if device_status == 'operational': continue
+
+            d_name = device.get('hostname', device.get('name', 'device'))
+            d_fullname = f"{full_name} > {d_name}"
+
             # Device herda o slug do pai para keywords
             device_node = {
                 'title': d_name,
@@ -132,35 +228,34 @@ def traverse_tree(node, results_list, query_tokens, show_all, parent_name=None):
                 'status': device_status,
                 'id': device.get('hostid', '0')
             }
-            evaluate_node(device_node, results_list, query_tokens, show_all, override_name=d_fullname, override_slug=slug)
+            add(device_node, override_name=d_fullname, override_slug=slug)
+
+@lru_cache(maxsize=1024)
+def slug_keywords(slug):
+    """Palavras-chave de um slug (o próprio slug, as partes e os aliases), partilhadas por todos os nós do serviço."""
+    keywords = {slug}
+    keywords.update(re.split(r'\W+', slug))
+    for alias_key, alias_values in ALIASES.items():
+        if alias_key in slug:
+            keywords.update(alias_values)
+    return frozenset(keywords)
 
-def evaluate_node(item, results_list, query_tokens, show_all, is_incident=False, override_name=None, override_slug=None):
+def evaluate_node(item, is_incident=False, override_name=None, override_slug=None):
+    """Devolve (alerta, palavras-chave) para um nó não operacional, ou None."""
     # 1. FILTRO DE STATUS (O Porteiro)
     # Se for operacional, MORRE AQUI.
     status = item.get('status', 'unknown')
     if status == 'operational':
-        return
+        return None
 
     # Normalização
     title = override_name if override_name else item.get('title', item.get('name', 'Item'))
     slug = override_slug if override_slug else item.get('slug', '')
 
     # 2. FILTRO DE RELEVÂNCIA (O Bibliotecário)
-    # Lista de palavras que representam este serviço
+    # Lista de palavras que representam este serviço (a interseção com a query é feita no índice)
     item_keywords = set(re.split(r'\W+', title.lower()))
-    item_keywords.add(slug.lower())
-    item_keywords.update(re.split(r'\W+', slug.lower()))
-
-    # Adicionar Aliases
-    for alias_key, alias_values in ALIASES.items():
-        if alias_key in slug.lower():
-            item_keywords.update(alias_values)
-
-    # Verifica Interseção
-    is_relevant = show_all or not query_tokens.isdisjoint(item_keywords)
-
-    if not is_relevant:
-        return
+    item_keywords.update(slug_keywords(slug.lower()))
 
     # --- SUCESSO: GERAR ALERTA ---
     status_pt = STATUS_MAP.get(status, status.upper())
@@ -181,9 +276,10 @@ def evaluate_node(item, results_list, query_tokens, show_all, is_incident=False,
         f"State clearly that the system is down."
     )
 
-    results_list.append({
+    alert = {
         'title': display_title,
         'url': unique_url,
         'content': content,
         'priority': 10
-    })
+    }
+    return alert, item_keywords
@@ -1,8 +1,21 @@
 # /usr/local/searxng/searx/engines/otobo_tickets.py
 
+import os
+import re
+import time
 import urllib.parse
 from lxml import html # Embora não usemos lxml, é boa prática mantê-lo se o template o tinha
 
+# Rastreio de pedidos do chat_proxy (llm/common/llm_trace.py, montado ao lado dos motores).
+# Opcional: sem o módulo (ou sem TRACE_FILE) o motor funciona igual, só não escreve spans.
+try:
+    from searx.engines import llm_trace
+except ImportError:
+    try:
+        import llm_trace  # chat_proxy com os motores em processo
+    except ImportError:
+        llm_trace = None
+
 # --- CONFIGURAÇÃO (EDITAR ESTES VALORES) ---
 
 # 1. O URL público do seu OTOBO (para construir os links)
@@ -16,8 +29,13 @@ TICKETS_API_URL = "https://tickets.linuxkafe.com/searx-api-tickets/"
 # 3. A CHAVE DE API (DEVE SER IGUAL À DO search_api.py)
 API_KEY = "***************************************"
 
+# 4. CABEÇALHO DO ID DO PEDIDO (o search_api.py regista os seus tempos com este ID)
+TRACE_HEADER = "X-Request-ID"
+
 # ----------------------------------------------
 
+tracer = llm_trace.Tracer(os.getenv("TRACE_FILE", ""), "searxng.tickets") if llm_trace else None
+
 # Configuração do motor
 categories = ['general', 'it']
 paging = False
@@ -53,15 +71,42 @@ def request(query, params):
         'X-API-Key': API_KEY
     }
     
+    # ID do pedido do chat_proxy (chega pelo engine_data): segue para a search_api
+    request_id = trace_request_id(params)
+    if request_id:
+        params['headers'][TRACE_HEADER] = request_id
+        params['trace_started'] = time.time()
+
     return params
 
 
+def trace_request_id(params):
+    """ID do pedido do chat_proxy (engine_data); só formatos seguros seguem num cabeçalho."""
+    request_id = (params.get('engine_data') or {}).get('request_id') or ''
+    return request_id if re.fullmatch(r'[A-Za-z0-9@._-]{8,64}', request_id) else None
+
+
+def record_span(resp, results):
+    """Span da ida à search_api (de request() até à resposta), se o pedido vier rastreado."""
+    params = getattr(resp, 'search_params', None) or {}
+    request_id = trace_request_id(params)
+    if tracer is None or not request_id or 'trace_started' not in params:
+        return
+    tracer.record('tickets.api', time.time() - params['trace_started'], trace_id=request_id,
+                  status='ok' if resp.ok else 'error', status_code=resp.status_code, results=results)
+
+
 # 2. FUNÇÃO PARA ANALISAR A RESPOSTA JSON
 def response(resp):
     """
     Analisa a resposta JSON da nossa micro-API.
     """
-    
+    results = parse_response(resp)
+    record_span(resp, len(results))
+    return results
+
+
+def parse_response(resp):
     # Se a API falhar (500, 400, etc.)
     # Se a autenticação falhar (401), também cairá aqui.
     if not resp.ok:
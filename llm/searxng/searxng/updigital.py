@@ -1,12 +1,38 @@
 # /usr/local/searxng/searx/engines/updigital.py
 
-# Usamos apenas módulos Python padrão para garantir que o motor carrega.
+# Usamos apenas módulos Python padrão para garantir que o motor carrega
+# (o httpx e o lxml já vêm com o próprio SearXNG).
+import os
+import re
+import time
+import sqlite3
+import threading
 import urllib.parse
-import urllib.request 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+import httpx
 from lxml import html
 import logging
 
+# Rastreio de pedidos do chat_proxy (llm/common/llm_trace.py, montado ao lado dos motores).
+# Opcional: sem o módulo (ou sem TRACE_FILE) o motor funciona igual, só não escreve spans.
+try:
+    from searx.engines import llm_trace
+except ImportError:
+    try:
+        import llm_trace  # chat_proxy com os motores em processo
+    except ImportError:
+        llm_trace = None
+
+# Índice local escrito pelo updigital_crawler.py (SQLite FTS5). Definido = modo índice:
+# o motor passa a offline e responde do índice; sem ficheiro volta à pesquisa no portal.
+INDEX_FILE = os.getenv("UPDIGITAL_INDEX_FILE", "")
+INDEX_RESULTS = 10
+
+tracer = llm_trace.Tracer(os.getenv("TRACE_FILE", ""), "searxng.updigital") if llm_trace else None
+
 # Configuração do motor
+engine_type = 'offline' if INDEX_FILE else 'online'
 categories = ['general', 'it']
 paging = False
 language_support = True
@@ -69,11 +95,34 @@ NOISE_WORDS_TO_REMOVE = [
 # Setup do Logger
 log = logging.getLogger(__name__)
 
+# --- PÁGINAS DE DETALHE ---
+BASE_URL = 'https://www.up.pt'
+# Número de resultados cujo conteúdo é extraído
+DETAIL_PAGES = 3
+# Prazo global para todas as páginas de detalhe (o callback do SearXNG não pode esperar 3 x 5 s)
+DETAIL_DEADLINE = 3.0
+DETAIL_TIMEOUT = httpx.Timeout(5.0, connect=2.0)
+# Conteúdo extraído por URL: servido sem pedido durante o TTL; depois, revalidado com ETag/Last-Modified
+PAGE_CACHE_TTL = 3600
+PAGE_CACHE_MAX = 500
+
+# Ligações keep-alive reutilizadas entre pedidos e threads
+_detail_client = httpx.Client(
+    headers=USER_AGENT_HEADER,
+    timeout=DETAIL_TIMEOUT,
+    follow_redirects=True,
+    limits=httpx.Limits(max_connections=DETAIL_PAGES * 2, max_keepalive_connections=DETAIL_PAGES, keepalive_expiry=60),
+)
+_detail_executor = ThreadPoolExecutor(max_workers=DETAIL_PAGES, thread_name_prefix='updigital-detail')
+# url -> {'content', 'etag', 'last_modified', 'checked_at'} (LRU)
+_page_cache = OrderedDict()
+_page_cache_lock = threading.Lock()
+
 
 # 1. FUNÇÃO PARA CONSTRUIR O URL DE PESQUISA (Página de Lista)
-def request(query, params):
+def clean_query(query):
     """
-    Constrói o URL para a pesquisa no portal UpDigital usando urllib.
+    Remove prefixos (PREFIXES_TO_STRIP) e palavras-ruído (NOISE_WORDS_TO_REMOVE) da query.
     """
 
     original_query = query
@@ -108,6 +157,16 @@ def request(query, params):
 
     # --- FIM DA MODIFICAÇÃO ---
 
+    return modified_query
+
+
+def request(query, params):
+    """
+    Constrói o URL para a pesquisa no portal UpDigital usando urllib.
+    """
+
+    original_query = query
+    modified_query = clean_query(query)
 
     # A base URL DEVE usar HTTPS
     base_url = 'https://www.up.pt/portal/pt/updigital/search/'
@@ -131,17 +190,120 @@ def request(query, params):
     return params
 
 
-# 2. FUNÇÃO PARA ANALISAR O HTML E EXTRAIR TUDO (LENTO)
+# 2. CONTEÚDO DAS PÁGINAS DE DETALHE
+def extract_main_content(html_content):
+    """Texto principal de uma página do portal (richtext-content, com fallback para //main)."""
+    details_dom = html.fromstring(html_content)
+
+    # XPath 1 (Principal,)
+    content_elements = details_dom.xpath("//div[contains(@class, 'richtext-content')]")
+
+    # XPath 2 (Fallback, se o 1 falhar)
+    if not content_elements:
+        content_elements = details_dom.xpath("//main")
+
+    content_parts = [el.text_content().strip() for el in content_elements]
+    return '\n'.join(part for part in content_parts if part)
+
+
+def _cache_get(url):
+    with _page_cache_lock:
+        entry = _page_cache.get(url)
+        if entry is not None:
+            _page_cache.move_to_end(url)
+        return entry
+
+
+def _cache_put(url, entry):
+    with _page_cache_lock:
+        _page_cache[url] = entry
+        _page_cache.move_to_end(url)
+        while len(_page_cache) > PAGE_CACHE_MAX:
+            _page_cache.popitem(last=False)
+
+
+def fetch_page_content(url):
+    """
+    Conteúdo extraído de uma página de detalhe. Dentro do TTL vem da cache sem qualquer pedido;
+    depois é revalidado com If-None-Match/If-Modified-Since (304 = não volta a ser descarregado nem analisado).
+    """
+    entry = _cache_get(url)
+    now = time.time()
+    if entry is not None and now - entry['checked_at'] < PAGE_CACHE_TTL:
+        return entry['content']
+
+    headers = {}
+    if entry is not None:
+        if entry['etag']: headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']: headers['If-Modified-Since'] = entry['last_modified']
+
+    details_resp = _detail_client.get(url, headers=headers)
+    if details_resp.status_code == 304 and entry is not None:
+        _cache_put(url, dict(entry, checked_at=now))
+        return entry['content']
+    if details_resp.status_code != 200:
+        log.warning('DEBUG UPDIGITAL (Response): Falha ao visitar link %s. Status: %s', url, details_resp.status_code)
+        return ''
+
+    content = extract_main_content(details_resp.content)
+    if not content:
+        log.warning('DEBUG UPDIGITAL (Response): XPath falhou (richtext E main) em %s', url)
+    _cache_put(url, {
+        'content': content,
+        'etag': details_resp.headers.get('ETag'),
+        'last_modified': details_resp.headers.get('Last-Modified'),
+        'checked_at': now,
+    })
+    return content
+
+
+def trace_request_id(params):
+    """ID do pedido do chat_proxy (engine_data), para os spans do motor."""
+    request_id = ((params or {}).get('engine_data') or {}).get('request_id') or ''
+    return request_id if re.fullmatch(r'[A-Za-z0-9@._-]{8,64}', request_id) else None
+
+
+def fetch_details(urls, deadline=None, request_id=None):
+    """
+    Visita as páginas em paralelo (ligações reutilizadas) com um prazo global.
+    Devolve {url: conteúdo}; páginas que não chegam a tempo ficam de fora, mas o pedido
+    continua em segundo plano e a próxima pesquisa já as encontra na cache.
+    """
+    deadline = DETAIL_DEADLINE if deadline is None else deadline
+    started = time.time()
+    futures = {_detail_executor.submit(fetch_page_content, url): url for url in urls}
+    done, not_done = wait(futures, timeout=deadline)
+    if tracer and request_id:
+        tracer.record('updigital.details', time.time() - started, trace_id=request_id,
+                      pages=len(urls), late=len(not_done))
+    if not_done:
+        log.warning('DEBUG UPDIGITAL (Response): %s página(s) de detalhe fora do prazo de %ss.', len(not_done), deadline)
+
+    contents = {}
+    for future in done:
+        url = futures[future]
+        try:
+            contents[url] = future.result()
+        except Exception as e:
+            log.warning('DEBUG UPDIGITAL (Response): Exceção ao visitar link %s: %s', url, str(e))
+    return contents
+
+
+# 3. FUNÇÃO PARA ANALISAR O HTML E EXTRAIR TUDO
 def response(resp):
     """
-    Analisa a lista E VISITA OS PRIMEIROS 3 LINKS (método síncrono).
+    Analisa a lista e extrai o conteúdo dos primeiros DETAIL_PAGES links (em paralelo, com cache).
     """
     if not resp.ok:
         log.warning('DEBUG UPDIGITAL (Response): Falha ao obter lista. Status: %s', resp.status_code)
         return []
 
-    dom = html.fromstring(resp.text)
-    results = []
+    return parse_search_page(resp.text, trace_request_id(getattr(resp, 'search_params', None)))
+
+
+def parse_search_page(page_html, request_id=None):
+    dom = html.fromstring(page_html)
+    entries = []
 
     # XPath original do seu ficheiro
     results_list = dom.xpath('//main//ul/li')
@@ -151,10 +313,7 @@ def response(resp):
     if not results_list:
         return []
 
-    BASE_URL = 'https://www.up.pt'
-
-    # Itera com um contador (i)
-    for i, li in enumerate(results_list):
+    for li in results_list:
 
         a_tags = li.xpath('./a') #
 
@@ -170,52 +329,87 @@ def response(resp):
         if url.startswith('/'):
             url = BASE_URL + url
 
-        content = ' ' # Conteúdo por defeito
-
-        # --- LÓGICA DE VISITA (Apenas os 3 primeiros) ---
-        # Só visita os 3 primeiros resultados para evitar o TIMEOUT
-        if i < 3:
-            try:
-                log.warning('DEBUG UPDIGITAL (Response): A visitar link [ %s / 10 ]: %s', (i+1), url)
-
-                # Cria o pedido com o User-Agent
-                req = urllib.request.Request(url, headers=USER_AGENT_HEADER)
-
-                # Visita o link individual (LENTO)
-                with urllib.request.urlopen(req, timeout=5) as details_resp:
-                    if details_resp.status == 200:
-                        html_content = details_resp.read()
-                        details_dom = html.fromstring(html_content)
-
-                        # XPath 1 (Principal,)
-                        content_elements = details_dom.xpath("//div[contains(@class, 'richtext-content')]")
+        entries.append((title, url))
 
-                        # XPath 2 (Fallback, se o 1 falhar)
-                        if not content_elements:
-                            log.warning('DEBUG UPDIGITAL (Response): XPath (richtext-content) falhou. A tentar fallback (//main)...')
-                            content_elements = details_dom.xpath("//main")
+    # --- LÓGICA DE VISITA (Apenas os primeiros) ---
+    detail_urls = list(dict.fromkeys(url for _, url in entries[:DETAIL_PAGES] if url))
+    contents = fetch_details(detail_urls, request_id=request_id) if detail_urls else {}
 
-                        if content_elements:
-                            content_parts = [el.text_content().strip() for el in content_elements]
-                            content = '\n'.join(part for part in content_parts if part)
-                        else:
-                            log.warning('DEBUG UPDIGITAL (Response): XPath falhou (richtext E main) em %s', url)
-                    else:
-                         log.warning('DEBUG UPDIGITAL (Response): Falha ao visitar link %s. Status: %s', url, details_resp.status)
-
-            except Exception as e:
-                log.warning('DEBUG UPDIGITAL (Response): Exceção ao visitar link %s: %s', url, str(e))
-        # --- FIM DA LÓGICA DE VISITA ---
-
-        if not content:
-            content = ' ' # Garante que não está vazio
+    results = []
+    for i, (title, url) in enumerate(entries):
+        content = contents.get(url, '') if i < DETAIL_PAGES else ''
 
         results.append(
                 {
                     'title': title,
                     'url': url,
-                    'content': content, # Adiciona o conteúdo extraído (ou ' ')
+                    'content': content or ' ', # Garante que não está vazio
                 }
             )
 
     return results
+
+
+# 4. MODO ÍNDICE (motor offline, sobre o índice do updigital_crawler.py)
+def index_match_expression(query):
+    """Expressão FTS5: cada palavra da query limpa como prefixo, em OR (o bm25 ordena)."""
+    tokens = [t for t in re.findall(r'\w+', clean_query(query).lower()) if len(t) > 1]
+    return ' OR '.join(f'"{t}"*' for t in tokens)
+
+
+def search_index(query, index_file=None, limit=INDEX_RESULTS):
+    """Pesquisa no índice local. None se o índice não existir (o chamador volta ao portal)."""
+    index_file = index_file or INDEX_FILE
+    if not index_file or not os.path.exists(index_file):
+        return None
+    expression = index_match_expression(query)
+    if not expression:
+        return []
+
+    # Só leitura: o crawler substitui o ficheiro por inteiro (os.replace) quando reconstrói o índice
+    conn = sqlite3.connect(f'file:{index_file}?mode=ro', uri=True)
+    try:
+        rows = conn.execute(
+            "SELECT url, title, content, snippet(pages, 2, '', '', ' … ', 32) "
+            "FROM pages WHERE pages MATCH ? ORDER BY bm25(pages, 0.0, 5.0, 1.0) LIMIT ?",
+            (expression, limit),
+        ).fetchall()
+    except sqlite3.Error as e:
+        log.warning('DEBUG UPDIGITAL (Index): Erro no índice %s: %s', index_file, str(e))
+        return None
+    finally:
+        conn.close()
+
+    # Como na pesquisa no portal: conteúdo completo nos primeiros resultados, excerto nos restantes
+    return [
+        {
+            'title': title,
+            'url': url,
+            'content': (content if i < DETAIL_PAGES else snippet) or ' ',
+        }
+        for i, (url, title, content, snippet) in enumerate(rows)
+    ]
+
+
+def search(query, params):
+    """Ponto de entrada do motor offline: índice local, com fallback para a pesquisa no portal."""
+    request_id = trace_request_id(params)
+    started = time.time()
+    results = search_index(query)
+    if tracer and request_id:
+        tracer.record('updigital.index', time.time() - started, trace_id=request_id,
+                      status='ok' if results is not None else 'error', results=len(results or []))
+    if results is not None:
+        return results
+
+    log.warning('DEBUG UPDIGITAL (Index): Índice %s indisponível. A pesquisar no portal.', INDEX_FILE)
+    params = request(query, dict(params or {}))
+    try:
+        list_resp = _detail_client.get(params['url'])
+    except httpx.HTTPError as e:
+        log.warning('DEBUG UPDIGITAL (Response): Exceção ao obter lista: %s', str(e))
+        return []
+    if list_resp.status_code != 200:
+        log.warning('DEBUG UPDIGITAL (Response): Falha ao obter lista. Status: %s', list_resp.status_code)
+        return []
+    return parse_search_page(list_resp.text, request_id)
@@ -0,0 +1,127 @@
+"""
+Poller do estado dos serviços (status.linuxkafe.com).
+
+Consulta o feed api/public_status em intervalos fixos, com ETag/If-Modified-Since, e escreve
+de forma atómica um snapshot local com o índice já construído pelo motor ilabstatus.
+O motor ilabstatus (SearXNG) e o kill switch do chat_proxy leem esse ficheiro em vez da rede.
+
+Uso:
+    python status_poller.py            # Ciclo contínuo (serviço systemd)
+    python status_poller.py --once     # Uma única verificação
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'searxng'))
+import ilabstatus
+
+# ==============================================================================
+# 1. CONFIGURAÇÃO
+# ==============================================================================
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('StatusPoller')
+
+STATUS_API_URL = os.getenv("STATUS_API_URL", ilabstatus.API_URL)
+STATUS_SNAPSHOT_FILE = os.getenv("STATUS_SNAPSHOT_FILE", ilabstatus.SNAPSHOT_FILE)
+STATUS_POLL_INTERVAL = int(os.getenv("STATUS_POLL_INTERVAL", 30))
+STATUS_POLL_TIMEOUT = float(os.getenv("STATUS_POLL_TIMEOUT", 10))
+
+# ==============================================================================
+# 2. SNAPSHOT
+# ==============================================================================
+
+def read_validators(path):
+    """ETag e Last-Modified do snapshot atual (para o pedido condicional)."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+        return snapshot.get("etag"), snapshot.get("last_modified")
+    except (OSError, ValueError):
+        return None, None
+
+def write_snapshot(path, snapshot):
+    # Escrita atómica: ficheiro temporário na mesma diretoria + os.replace()
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".status_snapshot.", dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        # Legível pelo utilizador do container do SearXNG e pelo chat_proxy
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path): os.unlink(tmp_path)
+        raise
+
+def poll_once(url, path, timeout):
+    """Uma verificação. Devolve 'updated', 'not_modified' ou 'failed'."""
+    etag, last_modified = read_validators(path)
+    headers = {"Accept": "application/json"}
+    # Só usamos os validadores se o snapshot existir (senão um 304 deixava-nos sem estado)
+    if os.path.exists(path):
+        if etag: headers["If-None-Match"] = etag
+        if last_modified: headers["If-Modified-Since"] = last_modified
+
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout) as resp:
+            content = resp.read()
+            etag, last_modified = resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            # Sem alterações: só renovamos o mtime, que os leitores usam para saber que o poller está vivo
+            os.utime(path, None)
+            return "not_modified"
+        logger.error(f"Feed de estado respondeu {e.code}.")
+        return "failed"
+    except Exception as e:
+        logger.error(f"Erro a consultar o feed de estado: {e}")
+        return "failed"
+
+    try:
+        data = json.loads(content)
+    except ValueError as e:
+        logger.error(f"Feed de estado com JSON inválido: {e}")
+        return "failed"
+
+    index = ilabstatus.build_status_index(data)
+    snapshot = {
+        "source": url,
+        "fetched_at": time.time(),
+        "etag": etag,
+        "last_modified": last_modified,
+        **index.to_dict()
+    }
+    write_snapshot(path, snapshot)
+    logger.info(f"Snapshot atualizado: {len(index.alerts)} alertas.")
+    return "updated"
+
+# ==============================================================================
+# 3. CICLO
+# ==============================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Poller do estado dos serviços para o ilabstatus e o chat_proxy")
+    parser.add_argument("--once", action="store_true", help="Faz uma única verificação e termina")
+    args = parser.parse_args()
+
+    if args.once:
+        return 0 if poll_once(STATUS_API_URL, STATUS_SNAPSHOT_FILE, STATUS_POLL_TIMEOUT) != "failed" else 1
+
+    logger.info(f"A verificar {STATUS_API_URL} a cada {STATUS_POLL_INTERVAL}s -> {STATUS_SNAPSHOT_FILE}")
+    while True:
+        started_at = time.monotonic()
+        poll_once(STATUS_API_URL, STATUS_SNAPSHOT_FILE, STATUS_POLL_TIMEOUT)
+        time.sleep(max(1.0, STATUS_POLL_INTERVAL - (time.monotonic() - started_at)))
+
+if __name__ == '__main__':
+    sys.exit(main())
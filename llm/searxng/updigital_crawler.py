@@ -0,0 +1,200 @@
+"""
+Crawler offline do portal UPdigital (up.pt/it).
+
+Percorre as páginas de ajuda do UPdigital, extrai o conteúdo principal com os mesmos XPaths
+do motor updigital (richtext-content, fallback //main) e grava-as num índice SQLite FTS5
+(tokenizer unicode61 com remoção de acentos e índices de prefixo). Com UPDIGITAL_INDEX_FILE
+definido, o motor updigital responde deste índice em vez de fazer scraping por pesquisa.
+
+Uso:
+    python updigital_crawler.py                                  # Crawl do portal
+    python updigital_crawler.py --source-dir ./paginas           # Páginas HTML guardadas localmente
+    python updigital_crawler.py --search "configurar eduroam"    # Pesquisa no índice existente
+"""
+import os
+import sys
+import time
+import sqlite3
+import logging
+import argparse
+import urllib.parse
+from collections import deque
+
+import httpx
+from lxml import html
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'searxng'))
+import updigital
+
+# ==============================================================================
+# 1. CONFIGURAÇÃO
+# ==============================================================================
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('UPdigitalCrawler')
+
+UPDIGITAL_INDEX_FILE = os.getenv("UPDIGITAL_INDEX_FILE", "/var/lib/updigital/updigital.db")
+# Página inicial e prefixo de URL dentro do qual o crawler se mantém
+CRAWL_START_URL = os.getenv("CRAWL_START_URL", "https://www.up.pt/portal/pt/updigital/")
+CRAWL_PREFIX = os.getenv("CRAWL_PREFIX", "https://www.up.pt/portal/pt/updigital/")
+CRAWL_MAX_PAGES = int(os.getenv("CRAWL_MAX_PAGES", 2000))
+# Pausa entre pedidos para não sobrecarregar o portal
+CRAWL_DELAY = float(os.getenv("CRAWL_DELAY", 0.2))
+# Páginas de listagem que não interessam ao índice
+CRAWL_SKIP = ("/search/",)
+
+SCHEMA = (
+    "CREATE VIRTUAL TABLE pages USING fts5("
+    "url UNINDEXED, title, content, "
+    "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+)
+
+# ==============================================================================
+# 2. EXTRAÇÃO
+# ==============================================================================
+
+def page_title(dom):
+    for xpath in ("//h1", "//title"):
+        elements = dom.xpath(xpath)
+        if elements:
+            title = elements[0].text_content().strip()
+            if title: return title
+    return ""
+
+def parse_page(html_content):
+    """Devolve (título, conteúdo principal, dom) de uma página."""
+    dom = html.fromstring(html_content)
+    return page_title(dom), updigital.extract_main_content(html_content), dom
+
+def normalize_url(url):
+    # Sem fragmento nem query: a mesma página não é indexada duas vezes
+    parts = urllib.parse.urlsplit(url)
+    return urllib.parse.urlunsplit((parts.scheme, parts.netloc, parts.path, "", ""))
+
+def in_scope(url):
+    return url.startswith(CRAWL_PREFIX) and not any(skip in url for skip in CRAWL_SKIP)
+
+# ==============================================================================
+# 3. FONTES (PORTAL OU DIRETORIA LOCAL)
+# ==============================================================================
+
+def crawl_portal(start_url, max_pages, delay):
+    """Percurso em largura dentro de CRAWL_PREFIX. Gera (url, título, conteúdo)."""
+    queue = deque([normalize_url(start_url)])
+    seen = set(queue)
+    visited = 0
+    with httpx.Client(headers=updigital.USER_AGENT_HEADER, timeout=updigital.DETAIL_TIMEOUT, follow_redirects=True) as client:
+        while queue and visited < max_pages:
+            url = queue.popleft()
+            try:
+                resp = client.get(url)
+            except httpx.HTTPError as e:
+                logger.warning(f"Erro a obter {url}: {e}")
+                continue
+            visited += 1
+            if resp.status_code != 200 or "html" not in resp.headers.get("Content-Type", "html"):
+                continue
+
+            title, content, dom = parse_page(resp.text)
+            if content: yield url, title, content
+
+            for href in dom.xpath("//a/@href"):
+                link = normalize_url(urllib.parse.urljoin(url, href))
+                if link not in seen and in_scope(link):
+                    seen.add(link)
+                    queue.append(link)
+            if delay: time.sleep(delay)
+    logger.info(f"{visited} páginas visitadas ({len(seen)} encontradas).")
+
+def read_directory(source_dir, base_url):
+    """
+    Páginas HTML guardadas localmente (para testes e importações manuais). O URL é o
+    <link rel="canonical"> da página ou, na falta dele, base_url + caminho relativo.
+    """
+    for root, _, files in os.walk(source_dir):
+        for name in sorted(files):
+            if not name.endswith((".html", ".htm")): continue
+            path = os.path.join(root, name)
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                html_content = f.read()
+            title, content, dom = parse_page(html_content)
+            if not content: continue
+            canonical = dom.xpath("//link[@rel='canonical']/@href")
+            relative = os.path.relpath(path, source_dir).replace(os.sep, "/")
+            yield (canonical[0] if canonical else urllib.parse.urljoin(base_url, relative)), title, content
+
+# ==============================================================================
+# 4. ÍNDICE
+# ==============================================================================
+
+def build_index(pages, index_file):
+    """Grava as páginas num índice novo e substitui o anterior de forma atómica. Devolve o nº de páginas."""
+    directory = os.path.dirname(os.path.abspath(index_file))
+    os.makedirs(directory, exist_ok=True)
+    tmp_file = f"{index_file}.tmp-{os.getpid()}"
+    if os.path.exists(tmp_file): os.unlink(tmp_file)
+
+    conn = sqlite3.connect(tmp_file)
+    try:
+        conn.execute(SCHEMA)
+        count = 0
+        seen = set()
+        for url, title, content in pages:
+            if url in seen: continue
+            seen.add(url)
+            conn.execute("INSERT INTO pages (url, title, content) VALUES (?, ?, ?)", (url, title, content))
+            count += 1
+        # Índice compacto: funde os segmentos FTS5 antes de publicar
+        conn.execute("INSERT INTO pages (pages) VALUES ('optimize')")
+        conn.commit()
+        conn.execute("VACUUM")
+    except BaseException:
+        conn.close()
+        os.unlink(tmp_file)
+        raise
+    conn.close()
+
+    # Um crawl que falhou por completo não apaga o índice anterior
+    if count == 0:
+        os.unlink(tmp_file)
+        raise RuntimeError("Nenhuma página com conteúdo: índice anterior mantido.")
+    os.chmod(tmp_file, 0o644)
+    os.replace(tmp_file, index_file)
+    return count
+
+# ==============================================================================
+# 5. EXECUÇÃO
+# ==============================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Crawler offline do portal UPdigital para o motor updigital")
+    parser.add_argument("--index", default=UPDIGITAL_INDEX_FILE, help="Ficheiro SQLite do índice")
+    parser.add_argument("--source-dir", help="Indexa páginas HTML guardadas nesta diretoria em vez do portal")
+    parser.add_argument("--base-url", default=CRAWL_PREFIX, help="URL base das páginas de --source-dir sem canonical")
+    parser.add_argument("--max-pages", type=int, default=CRAWL_MAX_PAGES)
+    parser.add_argument("--search", help="Pesquisa no índice existente e termina")
+    args = parser.parse_args()
+
+    if args.search:
+        results = updigital.search_index(args.search, args.index)
+        if results is None:
+            logger.error(f"Índice {args.index} inexistente ou inválido.")
+            return 1
+        for result in results:
+            print(f"{result['title']}\n  {result['url']}\n  {result['content'][:160]!r}")
+        return 0
+
+    started_at = time.monotonic()
+    if args.source_dir:
+        pages = read_directory(args.source_dir, args.base_url)
+    else:
+        pages = crawl_portal(CRAWL_START_URL, args.max_pages, CRAWL_DELAY)
+    try:
+        count = build_index(pages, args.index)
+    except RuntimeError as e:
+        logger.error(str(e))
+        return 1
+    logger.info(f"Índice {args.index}: {count} páginas em {time.monotonic() - started_at:.0f}s.")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())